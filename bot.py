@@ -1,17 +1,25 @@
 import datetime
-import json
+import time
+import asyncio
+import importlib
 import logging
 import traceback
 import aiohttp
 import sys
-from collections import Counter, deque
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 from discord.ext import commands
 import discord
 
-from config import CLIENT_ID, BOT_TOKEN, OWNER_ID
-from utils import context
-from utils.config import Config
+from config import CLIENT_ID, BOT_TOKEN, OWNER_ID, config_write_delay, config_journal, lazy_extensions, \
+    event_ring_size, event_sample_rate, event_dump_file, event_dump_backups
+from utils import context, db
+from utils.blacklist import Blacklist
+from utils.config import Config, JournalConfig
+from utils.events import EventRecorder
+from utils.metrics import InMemorySink
+from utils.prefixes import PrefixResolver
 
 description = """
 Qutils bot provides several important utilities for the server.
@@ -34,10 +42,7 @@ initial_extensions = (
 
 
 def _prefix_callable(bot, msg):
-    if msg.guild is None:
-        return commands.when_mentioned_or(*bot.base_prefixes)(bot, msg)
-    else:
-        return commands.when_mentioned_or(*bot.prefixes.get(msg.guild.id, bot.base_prefixes))(bot, msg)
+    return bot.prefix_resolver.get(msg.guild)
 
 
 def exception_handler(loop, ctx):
@@ -46,8 +51,18 @@ def exception_handler(loop, ctx):
     log.exception(err)
 
 
+def _import_extension(name):
+    # returns the import time and the top level packages the import has pulled in
+    before = set(sys.modules)
+    start = time.perf_counter()
+    importlib.import_module(name)
+    elapsed = time.perf_counter() - start
+    packages = {module.partition('.')[0] for module in set(sys.modules) - before}
+    return elapsed, sorted(packages - {name.partition('.')[0]})
+
+
 class Qutils(commands.AutoShardedBot):
-    def __init__(self, intents):
+    def __init__(self, intents, *, defer_extensions=True, import_workers=4):
         super().__init__(command_prefix=_prefix_callable, description=description, case_insensitive=True,
                          pm_help=None, help_attrs=dict(hidden=True), fetch_offline_members=True,
                          activity=discord.Game(name=":help for mods"), owner_id=int(OWNER_ID), intents=intents
@@ -60,18 +75,26 @@ class Qutils(commands.AutoShardedBot):
 
         self.session = aiohttp.ClientSession(loop=self.loop)
 
-        self._prev_events = deque(maxlen=10)
+        # summaries of the latest gateway frames, dumped on shutdown for post-mortems
+        self.event_recorder = EventRecorder(event_ring_size, sample_rate=event_sample_rate)
+
+        # metrics sink shared by the cogs, replace it to forward metrics elsewhere
+        self.metrics = InMemorySink()
 
+        config_store = JournalConfig if config_journal else Config
         # guild_id: list_role
-        self.prefixes = Config('prefixes.json')
+        self.prefixes = config_store('prefixes.json', write_behind=config_write_delay)
 
         # base default prefixes
         self.base_prefixes = ['?', '!']
 
+        # cached prefixes of every guild, messages not starting with one are dropped before a context is built
+        self.prefix_resolver = PrefixResolver(self, self.prefixes, self.base_prefixes)
+
         # guild_id and user_id mapped to True
         # these are users and guilds globally blacklisted
         # from using the bot
-        self.blacklist = Config('blacklist.json')
+        self.blacklist = Blacklist(config_store('blacklist.json', write_behind=config_write_delay))
 
         # in case of even further spam, add a cooldown mapping
         # for people who excessively spam commands
@@ -82,19 +105,86 @@ class Qutils(commands.AutoShardedBot):
         self._auto_spam_count = Counter()
         # remove default help command for a custom help
         self.remove_command('help')
-        for extension in initial_extensions:
-            try:
-                self.load_extension(extension)
-            except Exception as e:
-                log.exception(f'Failed to load extension {extension}.', exc_info=True)
-            else:
-                log.info(f'Extension loaded: {extension}')
+
+        # extension: (import seconds, setup seconds, imported packages)
+        self.extension_timings = {}
+        # extensions loaded once the bot is ready or once a message names an unknown command
+        self._deferred_extensions = [ext for ext in initial_extensions if defer_extensions and ext in lazy_extensions]
+        self._deferred_task = None
+        self.load_extensions([ext for ext in initial_extensions if ext not in self._deferred_extensions],
+                             workers=import_workers)
 
         # Set event loop exception handler
         self.loop.set_exception_handler(exception_handler)
 
-    async def on_socket_response(self, msg):
-        self._prev_events.append(msg)
+    def _setup_extension(self, extension, import_time, packages):
+        start = time.perf_counter()
+        try:
+            self.load_extension(extension)
+        except Exception as e:
+            log.exception(f'Failed to load extension {extension}.', exc_info=True)
+        else:
+            self.extension_timings[extension] = (import_time, time.perf_counter() - start, packages)
+            log.info(f'Extension loaded: {extension} ({import_time + self.extension_timings[extension][1]:.3f}s)')
+
+    def load_extensions(self, extensions, *, workers=4):
+        """Loads extensions, their modules are imported on a thread pool and set up in the given order."""
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            imports = [(extension, executor.submit(_import_extension, extension)) for extension in extensions]
+
+        for extension, future in imports:
+            try:
+                import_time, packages = future.result()
+            except Exception:
+                # load_extension imports it again and logs the error
+                import_time, packages = 0.0, []
+            self._setup_extension(extension, import_time, packages)
+
+    async def _load_deferred(self):
+        while self._deferred_extensions:
+            extension = self._deferred_extensions[0]
+            try:
+                import_time, packages = await self.loop.run_in_executor(None, _import_extension, extension)
+            except Exception:
+                import_time, packages = 0.0, []
+            self._setup_extension(extension, import_time, packages)
+            self._deferred_extensions.pop(0)
+
+    def load_deferred_extensions(self):
+        """Loads the deferred extensions in the background, the result can be awaited until they are loaded."""
+        if self._deferred_task is None:
+            self._deferred_task = self.loop.create_task(self._load_deferred())
+        # a cancelled waiter must not cancel the loading
+        return asyncio.shield(self._deferred_task)
+
+    def startup_report(self):
+        """Returns the load times of the extensions, the slowest first."""
+        lines = []
+        timings = sorted(self.extension_timings.items(), key=lambda item: item[1][0] + item[1][1], reverse=True)
+        for extension, (import_time, setup_time, packages) in timings:
+            lines.append(f'{extension:<20} import {import_time:7.3f}s  setup {setup_time:7.3f}s  '
+                         f'{", ".join(packages) or "-"}')
+        for extension in self._deferred_extensions:
+            lines.append(f'{extension:<20} deferred')
+        return '\n'.join(lines)
+
+    def dispatch(self, event_name, *args, **kwargs):
+        # recorded here instead of in a listener, so no coroutine is scheduled for every gateway frame
+        if event_name == 'socket_response':
+            self.event_recorder.record(args[0])
+        elif event_name == 'socket_raw_receive':
+            self.event_recorder.received(len(args[0]))
+        super().dispatch(event_name, *args, **kwargs)
+
+    def dispatch_awaitable(self, event_name, *args, **kwargs):
+        """Dispatches an event like :meth:`dispatch` but returns its extra listeners instead of scheduling them.
+
+        The ``on_`` method of the bot and :meth:`wait_for` still get the event,
+        the caller runs the returned listeners so it can wait for them.
+        """
+        # skips BotBase.dispatch, the only part of it scheduling the extra listeners
+        super(commands.bot.BotBase, self).dispatch(event_name, *args, **kwargs)
+        return list(self.extra_events.get('on_' + event_name, []))
 
     async def on_command_error(self, ctx, error):
         if isinstance(error, commands.NoPrivateMessage):
@@ -110,13 +200,11 @@ class Qutils(commands.AutoShardedBot):
         elif isinstance(error, commands.ArgumentParsingError):
             await ctx.send(error)
 
-    def get_guild_prefixes(self, guild, *, local_inject=_prefix_callable):
-        proxy_msg = discord.Object(id=0)
-        proxy_msg.guild = guild
-        return local_inject(self, proxy_msg)
+    def get_guild_prefixes(self, guild):
+        return self.prefix_resolver.get(guild)
 
     def get_raw_guild_prefixes(self, guild_id):
-        return self.prefixes.get(guild_id, ['?', '!'])
+        return self.prefix_resolver.raw(guild_id)
 
     async def set_guild_prefixes(self, guild, prefixes):
         if len(prefixes) == 0:
@@ -127,19 +215,17 @@ class Qutils(commands.AutoShardedBot):
             await self.prefixes.put(guild.id, sorted(set(prefixes), reverse=True))
 
     async def add_to_blacklist(self, object_id):
-        await self.blacklist.put(object_id, True)
+        await self.blacklist.add(object_id)
 
     async def remove_from_blacklist(self, object_id):
-        try:
-            await self.blacklist.remove(object_id)
-        except KeyError:
-            pass
+        await self.blacklist.remove(object_id)
 
     async def on_ready(self):
         if not hasattr(self, 'uptime'):
             self.uptime = datetime.datetime.utcnow()
 
         log.info(f'Bot ready, User: {self.user} (ID: {self.user.id})')
+        self.load_deferred_extensions()
 
     async def on_resumed(self):
         print('Season has been resumed...')
@@ -167,10 +253,22 @@ class Qutils(commands.AutoShardedBot):
         return wh.send(embed=embed)
 
     async def process_commands(self, message):
+        if not self.prefix_resolver.matches(message):
+            self.metrics.increment('commands.prefilter', result='skipped')
+            return
+
+        self.metrics.increment('commands.prefilter', result='passed')
         ctx = await self.get_context(message, cls=context.Context)
 
         if ctx.command is None:
-            return
+            if not self._deferred_extensions:
+                return
+
+            # the command might belong to an extension that is not loaded yet
+            await self.load_deferred_extensions()
+            ctx = await self.get_context(message, cls=context.Context)
+            if ctx.command is None:
+                return
 
         if ctx.author.id in self.blacklist:
             return
@@ -194,11 +292,16 @@ class Qutils(commands.AutoShardedBot):
         else:
             self._auto_spam_count.pop(author_id, None)
 
+        cog_name = ctx.cog.qualified_name if ctx.cog else '-'
+        token = db.query_tags.set((cog_name, ctx.command.qualified_name))
         try:
             await self.invoke(ctx)
         finally:
-            # Just in case we have any outstanding DB connections
-            await ctx.release()
+            try:
+                # Just in case we have any outstanding DB connections
+                await ctx.release()
+            finally:
+                db.query_tags.reset(token)
 
     async def on_message(self, message):
         if message.author.bot:
@@ -219,19 +322,18 @@ class Qutils(commands.AutoShardedBot):
     async def close(self):
         await super().close()
         await self.session.close()
+        await self.prefixes.flush()
+        await self.blacklist.flush()
 
     def run(self):
         try:
             super().run(BOT_TOKEN, reconnect=True)
         finally:
-            with open('prev_events.log', 'w', encoding='utf-8') as fp:
-                for data in self._prev_events:
-                    try:
-                        x = json.dumps(data, ensure_ascii=True, indent=4)
-                    except:
-                        fp.write(f'{data}\n')
-                    else:
-                        fp.write(f'{x}\n')
+            if event_dump_file:
+                try:
+                    self.event_recorder.dump(event_dump_file, backups=event_dump_backups)
+                except OSError:
+                    log.exception(f'Could not dump the gateway events to {event_dump_file}.')
 
     @property
     def config(self):
@@ -19,6 +19,8 @@ from config import GUILD_ID, ACTIVITY_ROLE_NAME, ACTIVITY_INCLUDED_ROLES, ADMIN_
     TIER1, TIER1toTIER2, TIER2, TIER2toTIER3, TIER3, base_json_dir, short_delay, mid_delay
 from utils import time, db, formats, helpers
 from utils.formats import EmbedGenerator, CustomEmbed, Plural, pag
+from utils.cache import TTLCache
+from utils.paging import KeysetSource, LazyStringNavigator
 
 log = logging.getLogger('root')
 
@@ -38,6 +40,12 @@ class DiscardedUsers(db.Table):
     extra = db.Column(db.JSON, default="'{}'::jsonb", nullable=False)
 
 
+# a member discarded again keeps the count of the earlier discards
+discarded_upsert_update = {'num_discarded': 'discardedusers.num_discarded + 1',
+                           **{name: f'EXCLUDED.{name}'
+                              for name in DiscardedUsers.get_col_names(excluded=['id', 'num_discarded', 'extra'])}}
+
+
 class ExceptionMembers(db.Table):
     member_id = db.Column(db.Integer(big=True), primary_key=True)
     guild_id = db.Column(db.Integer(big=True), primary_key=True)
@@ -46,6 +54,47 @@ class ExceptionMembers(db.Table):
     reason = db.Column(db.String, default='')
 
 
+past_schedule_query = db.Query('admin_past_schedule', """
+    WITH deleted AS (DELETE FROM reminders
+    WHERE event = 'schedule' AND expires < NOW() RETURNING *)
+    SELECT id, expires, (extra #>> '{args,1}') AS members,
+    (extra #>> '{args,2}') AS exceptions,
+    (extra #>> '{args,3}') AS reason,
+    (extra #>> '{args,4}')::boolean AS is_ban,
+    (extra #>> '{args,5}') AS role_id,
+    (extra #>> '{args,6}') AS included_roles
+    FROM deleted
+    ORDER BY expires DESC
+    LIMIT 1;
+""")
+
+# $2 is the date to check and $3 is the schedule gap such as '5d'
+later_schedule_query = db.Query('admin_later_schedule', """
+    SELECT *
+    FROM reminders
+    WHERE $2::date < (expires + $3::text::interval)
+    AND event = 'schedule'
+    AND extra #>> '{args,0}' = $1;
+""")
+
+nearby_schedule_query = db.Query('admin_nearby_schedule', """
+    SELECT *
+    FROM reminders
+    WHERE $2::date BETWEEN (expires - $3::text::interval) AND (expires + $3::text::interval)
+    AND event = 'schedule'
+    AND extra #>> '{args,0}' = $1;
+""")
+
+# $2 is the role upgrade gap such as '1d'
+upcoming_role_upgrade_query = db.Query('admin_upcoming_role_upgrade', """
+    SELECT *
+    FROM reminders
+    WHERE expires BETWEEN NOW() AND (NOW() + $2::text::interval)
+    AND event = 'role_upgrade'
+    AND extra #>> '{args,0}' = $1;
+""")
+
+
 class Admin(commands.Cog):
     """
     Admin functionality
@@ -53,6 +102,8 @@ class Admin(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
+        # guild id -> exception member records of the guild
+        self.exceptions = TTLCache(lambda guild_id: self.fetch_all_exceptions(self.bot.pool, guild_id))
 
 # ****************  event handlers *********************
     @commands.Cog.listener('on_member_remove')
@@ -64,18 +115,6 @@ class Admin(commands.Cog):
     async def cleanup_schedule(self):
         """ Remove old scheduled member removal events and reschedule if no other removal event exists"""
 
-        query = f"""WITH deleted AS (DELETE FROM reminders
-                    WHERE event = 'schedule' AND expires < NOW() RETURNING *) 
-                    SELECT id, expires, (extra #>> '{{args,1}}') AS members, 
-                    (extra #>> '{{args,2}}') AS exceptions,
-                    (extra #>> '{{args,3}}') AS reason, 
-                    (extra #>> '{{args,4}}')::boolean AS is_ban, 
-                    (extra #>> '{{args,5}}') AS role_id,
-                    (extra #>> '{{args,6}}') AS included_roles
-                    FROM deleted 
-                    ORDER BY expires DESC
-                    LIMIT 1;
-                 """
         guild = await helpers.get_guild_by_id(self.bot, GUILD_ID)
         if guild is None:
             return log.exception('Guild is none in cleanup_schedule function')
@@ -88,18 +127,13 @@ class Admin(commands.Cog):
                 return await channel.send('Sorry, remainder cog is currently unavailable to use in cleanup_schedule.'
                                           'Please try again later')
 
-        row = await self.bot.pool.fetchrow(query)
+        row = await past_schedule_query.fetchrow(self.bot.pool)
         if row:
             activity_schedule_gap_dt = time.FutureTime(activity_schedule_gap)
             expire_date = activity_schedule_gap_dt.dt - (datetime.datetime.utcnow() - row['expires'])
             # first check whether another scheduled removal exists within a day range
-            check_query = f"""SELECT *
-                              FROM reminders
-                              WHERE '{expire_date}'::date < (expires + '{str(activity_schedule_gap)} days'::interval)
-                              AND event = 'schedule'
-                              AND extra #>> '{{args,0}}' = $1;
-                            """
-            total = await self.bot.pool.fetchrow(check_query, str(GUILD_ID))
+            total = await later_schedule_query.fetchrow(self.bot.pool, str(GUILD_ID), expire_date,
+                                                        str(activity_schedule_gap))
             if total is None:
                 activity_role = guild.get_role(int(row['role_id']))
                 exception_ids = json.loads(row['exceptions'])
@@ -174,6 +208,25 @@ class Admin(commands.Cog):
         else:
             await ctx.channel.send('\N{OK HAND SIGN}')
 
+    @commands.command(name='dbstats', hidden=True)
+    @commands.is_owner()
+    async def db_stats(self, ctx):
+        """Shows the pool usage and the slowest statements of the last hour."""
+        pool = self.bot.pool
+        try:
+            stats, slowest = pool.stats(), pool.monitor.slowest_statements()
+        except AttributeError:
+            return await ctx.send('The pool is not instrumented.')
+
+        table = formats.TabularData()
+        table.set_columns(['Seconds', 'Rows', 'Cog', 'Command', 'Query'])
+        table.add_rows([f'{elapsed:.3f}', rows, cog, command, textwrap.shorten(query, width=60)]
+                       for elapsed, _, query, cog, command, rows in slowest)
+
+        pool_text = ', '.join(f'{name}: {value}' for name, value in stats.items())
+        await ctx.safe_send(f'**Pool**: {pool_text}\n**Queries**: {pool.monitor.queries} '
+                            f'({pool.monitor.failed} failed)\n```\n{table.render()}\n```')
+
     @commands.command(name='set_prefix', help='Set the server prefix',
                       usage='<prefix_to_set>\n\n'
                             'For setting multiple prefix, use: "! ? - ...."\n\n'
@@ -270,22 +323,13 @@ class Admin(commands.Cog):
             guild = ctx.guild
 
             # get global exception members and include them in exceptions
-            global_exception_member_records = await self.fetch_all_exceptions(self.bot.pool, guild.id)
+            global_exception_member_records = await self.exceptions.get(guild.id)
             global_exception_members = [await helpers.get_member_by_id(guild, record['member_id'])
                                         for record in global_exception_member_records]
             exceptions = [member for member in global_exception_members if member and member not in exceptions]
 
-            valid_members, query_params = [], []
+            valid_members, discarded_rows = [], []
             member_text, exception_member_text = '', ''
-            col_list = DiscardedUsers.get_col_names(excluded=['id', 'num_discarded', 'extra'])
-            col_names = ', '.join(col_list)
-            col_val_placeholder = ', '.join(f'${3 + i}' for i in range(len(col_list)))
-            query = f"""INSERT INTO discardedusers AS du (id, num_discarded, {col_names})
-                        VALUES ($1, $2, {col_val_placeholder})
-                        ON CONFLICT (id)
-                        DO UPDATE
-                        SET (num_discarded, {col_names}) = ROW(du.num_discarded+1, {col_val_placeholder});
-                    """
 
             for member in guild.members:
                 if member not in exceptions:
@@ -293,9 +337,10 @@ class Admin(commands.Cog):
                         valid_members.append(member)
                         member_text += (member.display_name + '\n')
                         top_role_id = member.top_role.id
-                        query_params.append(
-                            (member.id, 1, member.display_name, member.joined_at, datetime.datetime.utcnow(),
-                             is_ban, top_role_id, reason))
+                        discarded_rows.append(
+                            dict(id=member.id, num_discarded=1, nickname=member.display_name,
+                                 joined_at=member.joined_at, discarded_at=datetime.datetime.utcnow(),
+                                 is_banned=is_ban, last_role_id=top_role_id, reason=reason))
                 else:
                     exception_member_text += (member.display_name + '\n')
 
@@ -324,7 +369,7 @@ class Admin(commands.Cog):
                     else:
                         await member.kick(reason=reason)
 
-                await ctx.db.executemany(query, query_params)
+                await DiscardedUsers.upsert_many(discarded_rows, update=discarded_upsert_update, connection=ctx.db)
 
             elif confirm is None:
                 await ctx.send("Operation has been cancelled.", delete_after=short_delay)
@@ -337,38 +382,54 @@ class Admin(commands.Cog):
                            'Ex: !discard fetch True')
     @commands.guild_only()
     async def fetch(self, ctx, to_csv: typing.Optional[bool] = False):
-        query = """SELECT format('<@%s>', id) AS "User",
+        # id is the key of the pages, it is neither displayed nor written to the CSV file
+        columns = """format('<@%s>', id) AS "User",
                     nickname AS "Nickname",
                     num_discarded AS "Num. discarded",
                     TO_CHAR(joined_at :: DATE, 'dd/mm/yyyy') AS "Joined", 
                     TO_CHAR(discarded_at :: DATE, 'dd/mm/yyyy') AS "Discarded",
                     (CASE WHEN is_banned THEN 'B' ELSE 'K' end) AS "Type",
                     (CASE WHEN last_role_id IS NOT NULL THEN format('<@&%s>', last_role_id) ELSE '-' end) AS "Role",
-                    (CASE WHEN reason <> '' THEN reason ELSE '-' end) AS "Reason"
-                    FROM discardedusers"""
+                    (CASE WHEN reason <> '' THEN reason ELSE '-' end) AS "Reason",
+                    id"""
+        table_columns = ["User", "Num. discarded", "Joined", "Discarded", "Type", "Role", "Reason"]
+        # the widest cell of every column, so all the pages have the same widths and size, NULL is shown as None
+        max_lengths = ', '.join(f"""MAX(length(COALESCE("{column}"::text, 'None')))""" for column in table_columns)
+        widths_query = f'SELECT {max_lengths} FROM (SELECT {columns} FROM discardedusers) AS t;'
+
+        def new_table():
+            data = formats.TabularData()
+            data.set_columns(table_columns)
+            for column, width in zip(table_columns, widths.values()):
+                data.set_col_width(column, width or 0)
+            return data
+
+        # leaves some room to the navigator under the message limit
+        max_chars = 1900
+
+        def render(rows, start):
+            data = new_table()
+            data.add_rows(rows, [1, 8])
+            return next(data.render_pages(max_chars), 'No results found...')
 
         sent_messages, sent_navs = [ctx.message], []
         try:
-            records = await ctx.db.fetch(query)
-            if len(records) == 0:
+            widths = await ctx.pool.fetchrow(widths_query)
+            source = KeysetSource(ctx.pool, 'discardedusers', columns, 'id',
+                                  per_page=new_table().rows_per_page(max_chars))
+            if await source.count() == 0:
                 return await ctx.send('No results found...', delete_after=mid_delay)
 
-            nav = pag.StringNavigatorFactory(max_lines=20, enable_truncation=False)
-            data = formats.TabularData(nav.line_break)
-            table_columns = ["User", "Num. discarded", "Joined", "Discarded", "Type", "Role", "Reason"]
-            data.set_columns(table_columns)
-            data.add_rows(records, [1])
-            nav.prefix = data.get_column_str()
-
-            nav += data.render(render_column=False)
-            emb_nav = nav.build(ctx=ctx)
+            emb_nav = LazyStringNavigator(ctx, source, render, await source.page_count())
             emb_nav.start()
             sent_navs.append(emb_nav)
 
             if to_csv:
-                f = data.to_csv(["ID", "Nickname", "Num. discarded", "Joined", "Discarded", "Type", "Role", "Reason"])
+                csv_columns = ["ID", "Nickname", "Num. discarded", "Joined", "Discarded", "Type", "Role", "Reason"]
+                csv_rows = (tuple(row.values())[:-1] async for row in source.rows())
+                f, filename = await formats.TabularData.stream_csv(csv_columns, csv_rows, "removed_user_info.txt")
                 return await ctx.channel.send(content="Removed users CSV file",
-                                              file=File(fp=f, filename="removed_user_info.txt"), delete_after=mid_delay)
+                                              file=File(fp=f, filename=filename), delete_after=mid_delay)
         finally:
             await helpers.cleanup_messages(ctx.channel, sent_messages, navigators=sent_navs, delete_after=120)
 
@@ -423,14 +484,8 @@ class Admin(commands.Cog):
             guild = ctx.guild
 
             # first check whether another scheduled removal exists within a day range
-            query = f"""SELECT *
-                        FROM reminders
-                        WHERE '{duration.dt}'::date BETWEEN (expires - '{str(activity_schedule_gap)} days'::interval) AND 
-                        (expires + '{str(activity_schedule_gap)} days'::interval)
-                        AND event = 'schedule'
-                        AND extra #>> '{{args,0}}' = $1;
-                    """
-            total = await self.bot.pool.fetchrow(query, str(guild.id))
+            total = await nearby_schedule_query.fetchrow(self.bot.pool, str(guild.id), duration.dt,
+                                                         str(activity_schedule_gap))
             if total:
                 return await ctx.send(f'There is already a scheduled event has the time gap '
                                       f'less than {activity_schedule_gap} days', delete_after=short_delay)
@@ -449,7 +504,7 @@ class Admin(commands.Cog):
                 return await self.cog_command_error(ctx, commands.BadArgument('Role defining member set is not valid.'))
 
             # get global exception members and include them in exceptions
-            global_exception_member_records = await self.fetch_all_exceptions(self.bot.pool, guild.id)
+            global_exception_member_records = await self.exceptions.get(guild.id)
             global_exception_members = [await helpers.get_member_by_id(guild, record['member_id'])
                                         for record in global_exception_member_records]
             exceptions = exceptions + [member for member in global_exception_members if member and member not in exceptions]
@@ -682,6 +737,7 @@ class Admin(commands.Cog):
             await self.remove_exception_db(guild.id)
 
             await self.bot.pool.execute(query, member.id, guild.id, author.id, duration.dt, reason)
+            self.exceptions.invalidate(guild.id)
             return await ctx.send(f'Exception added for: {member.mention} by: {author.mention} '
                                   f'until: {duration.dt.strftime("%Y-%m-%d %H:%M:%S")} for reason: {reason}',
                                   delete_after=short_delay)
@@ -702,10 +758,10 @@ class Admin(commands.Cog):
                 WHERE (guild_id = $1) AND (until < NOW() OR 
                 ($2::BIGINT is not null and member_id::BIGINT = $2))"""
 
-        # first clear DB
-        await self.fetch_all_exceptions(self.bot.pool, guild_id)
-
-        return await self.bot.pool.execute(query, guild_id, member_id)
+        try:
+            return await self.bot.pool.execute(query, guild_id, member_id)
+        finally:
+            self.exceptions.invalidate(guild_id)
 
     @schedule.command(name='fetch_exception', help='Fetch all exceptions in DB',
                       usage="Ex: !schedule fetch_exception",
@@ -717,7 +773,7 @@ class Admin(commands.Cog):
             author = ctx.author
             guild = ctx.guild
 
-            records = await self.fetch_all_exceptions(self.bot.pool, guild.id)
+            records = await self.exceptions.get(guild.id)
             if len(records) == 0:
                 return await ctx.send(f'No exception has been found.', delete_after=short_delay)
 
@@ -753,7 +809,7 @@ class Admin(commands.Cog):
             author = ctx.author
             guild = ctx.guild
 
-            records = await self.fetch_all_exceptions(self.bot.pool, guild.id)
+            records = await self.exceptions.get(guild.id)
             if len(records) == 0:
                 return await ctx.send(f'No exception has been found.', delete_after=short_delay)
 
@@ -947,18 +1003,9 @@ class Admin(commands.Cog):
             except HTTPException as err:
                 log.info(f'Error on creating invitation: {err}')
 
-        query_params = []
-        col_list = DiscardedUsers.get_col_names(excluded=['id', 'num_discarded', 'extra'])
-        col_names = ', '.join(col_list)
-        col_val_placeholder = ', '.join(f'${3 + i}' for i in range(len(col_list)))
-        query = f"""INSERT INTO discardedusers AS du (id, num_discarded, {col_names})
-                        VALUES ($1, $2, {col_val_placeholder})
-                        ON CONFLICT (id)
-                        DO UPDATE
-                        SET (num_discarded, {col_names}) = ROW(du.num_discarded+1, {col_val_placeholder});
-                    """
+        discarded_rows = []
 
-        global_exception_member_records = await self.fetch_all_exceptions(self.bot.pool, guild.id)
+        global_exception_member_records = await self.exceptions.get(guild.id)
         global_exception_members = [await helpers.get_member_by_id(guild, record['member_id'])
                                     for record in global_exception_member_records]
         global_exception_members = [member for member in global_exception_members if member is not None]
@@ -982,13 +1029,14 @@ class Admin(commands.Cog):
 
                         await member.kick(reason=reason)
 
-                    query_params.append(
-                        (member.id, 1, member.display_name, member.joined_at, datetime.datetime.utcnow(),
-                         is_ban, top_role_id, reason))
+                    discarded_rows.append(
+                        dict(id=member.id, num_discarded=1, nickname=member.display_name,
+                             joined_at=member.joined_at, discarded_at=datetime.datetime.utcnow(),
+                             is_banned=is_ban, last_role_id=top_role_id, reason=reason))
                 else:
                     log.info(f'Member is excluded from removal on event handler: {member.mention}')
 
-        await self.bot.pool.executemany(query, query_params)
+        await DiscardedUsers.upsert_many(discarded_rows, update=discarded_upsert_update)
         log.info(f'Scheduled removal event created at: {timer.created_at.strftime("%Y-%m-%d %H:%M:%S")} '
                  f'has been executed on: {datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")}\n'
                  f'Expected removal date was: {timer.expires.strftime("%Y-%m-%d %H:%M:%S")}')
@@ -1030,14 +1078,7 @@ class Admin(commands.Cog):
 #     ********* autonomous functions ************
 
     async def update_roles(self):
-        query = f"""SELECT *
-                    FROM reminders
-                    WHERE expires BETWEEN NOW() AND
-                    (NOW() + '{str(role_upgrade_gap)}'::interval)
-                    AND event = 'role_upgrade'
-                    AND extra #>> '{{args,0}}' = $1;
-                """
-        total = await self.bot.pool.fetchrow(query, str(GUILD_ID))
+        total = await upcoming_role_upgrade_query.fetchrow(self.bot.pool, str(GUILD_ID), str(role_upgrade_gap))
 
         if total:
             return log.info(f'There is already schedule role upgrade on date: '
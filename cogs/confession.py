@@ -23,7 +23,9 @@ import logging
 from config import ADMIN_CHANNEL_ID, CONFESSION_CHANNEL_ID, GUILD_ID, valid_confession_roles,\
     message_timeout, warn_limit, command_cooldown, short_delay, mid_delay, long_delay, TIER5
 from utils import db, helpers
-from utils.formats import CustomEmbed
+from utils.cache import TTLCache
+from utils.paging import KeysetSource, LazyEmbedNavigator, lines_page
+from utils.formats import CustomEmbed, TabularData
 from libneko import pag
 
 log = logging.getLogger('root')
@@ -83,6 +85,40 @@ class Irritations(db.Table):
     reason = db.Column(db.String, default='')
 
 
+ban_code_exists_query = db.Query('confession_ban_code_exists', """
+    SELECT 1
+    FROM confessions
+    WHERE confession_ban_code = $1
+""")
+
+confession_by_ban_code_query = db.Query('confession_by_ban_code', """
+    SELECT *
+    FROM confessions
+    WHERE confession_ban_code = $1
+    AND guild_id = $2
+""")
+
+warns_by_ban_code_query = db.Query('confession_warns_by_ban_code', """
+    SELECT *
+    FROM warns
+    WHERE confession_ban_code = $1
+    AND guild_id = $2
+""")
+
+confession_channel_query = db.Query('confession_channel', """
+    SELECT channel_id
+    FROM confessionservers
+    WHERE guild_id = $1
+""")
+
+banned_user_query = db.Query('confession_banned_user', """
+    SELECT *
+    FROM bannedusers
+    WHERE user_hash_id = $1 AND
+    guild_id = $2
+""")
+
+
 class Confession(commands.Cog):
 
     def __init__(self, bot):
@@ -91,6 +127,12 @@ class Confession(commands.Cog):
         self.default_guild_id = GUILD_ID
         self.default_channel_id = CONFESSION_CHANNEL_ID
         self.currently_confessing = set()  # A set rather than a fetch_schedule because it uses a hash table
+        # guild id -> confession channel id or None if not set
+        self.confession_channels = TTLCache(self._load_confession_channel)
+        # None -> guild id to confession channel id mapping of every confession server
+        self.confession_servers = TTLCache(self._load_confession_servers, max_size=1)
+        # (user hash id, guild id) -> banned user record or None
+        self.banned_users = TTLCache(self._load_banned_user)
 
     # ********** Events **************
     @commands.Cog.listener()
@@ -112,7 +154,7 @@ class Confession(commands.Cog):
 
         # Check for existing
         guild = channel.guild
-        channel_id = self.confession_servers_map.get(guild.id, None)
+        channel_id = await self.confession_channels.get(guild.id)
         if channel_id is None:
             return
 
@@ -124,7 +166,8 @@ class Confession(commands.Cog):
         if num_deleted > 0:
             log.info(f"Deleting {num_deleted} inaccessible confession channel with **ID: {channel.id} "
                      f"({channel.name})** in **{guild.name}**.")
-        del self.confession_servers_map[guild.id]
+        self.confession_channels.invalidate(guild.id)
+        self.confession_servers.invalidate(None)
 
     @commands.Cog.listener('on_raw_message_delete')
     async def confession_delete_listener(self, payload: RawMessageDeleteEvent):
@@ -160,11 +203,11 @@ class Confession(commands.Cog):
     # ********* Server and channel settings related ******
     async def insert_and_update_servers(self, guild_id, channel_id):
         """ Insert a confession channel with given server id
-            and update server-confession channel map in the instance """
+            and update the cached confession channel of the server """
         # insert default confession server to DB
         await self.insert_confession_server(guild_id, channel_id)
-        # fetch all confession server ids with corresponding channel ids from DB and update
-        await self.update_confession_server_ids()
+        self.confession_channels.invalidate(guild_id)
+        self.confession_servers.invalidate(None)
 
     async def remove_unreachable_servers(self):
         """ Remove unreachable (deleted or permission changed)
@@ -185,18 +228,28 @@ class Confession(commands.Cog):
             if channel is None:
                 log.info(f"Deleting inaccessible channel with ID {channel_id} in guild with ID: {guild_id}")
                 await self.bot.pool.execute(delete_query, channel_id)
-                del self.confession_servers_map[guild_id]
-
-    async def update_confession_server_ids(self):
-        """ Update confession server map"""
-        self.confession_servers_map = await self.get_confession_server_ids()
+                self.confession_channels.invalidate(guild_id)
+                self.confession_servers.invalidate(None)
 
     async def get_confession_server_ids(self):
         """ Get all confession servers ids with confession channel ids in dict format"""
+        return await self.confession_servers.get(None)
+
+    async def _load_confession_servers(self, _):
         query = """ SELECT * FROM confessionservers """
         rows = await self.bot.pool.fetch(query)
 
-        return {row['guild_id']: row['channel_id'] for row in rows}
+        servers = {row['guild_id']: row['channel_id'] for row in rows}
+        for guild_id, channel_id in servers.items():
+            self.confession_channels.set(guild_id, channel_id)
+        return servers
+
+    async def _load_confession_channel(self, guild_id):
+        return await confession_channel_query.fetchval(self.bot.pool, guild_id)
+
+    async def _load_banned_user(self, key):
+        user_hash_id, guild_id = key
+        return await banned_user_query.fetchrow(self.bot.pool, user_hash_id, guild_id)
 
     async def insert_confession_server(self, guild_id, channel_id):
         """ Insert or update a channel id with a confession server"""
@@ -221,15 +274,10 @@ class Confession(commands.Cog):
     @staticmethod
     async def get_unique_ban_code(ctx, n: int = 5, attempt: int = 10) -> str:
         """ Get unique ban code for a confession by checking DB """
-        query = f"""SELECT *
-                    FROM confessions
-                    WHERE confession_ban_code = $1
-                """
-
         # Check n attempts to get a unique code not in DB
         for _ in range(attempt):
             ban_code = Confession.get_code(n)
-            row = await ctx.db.fetchrow(query, ban_code)
+            row = await ban_code_exists_query.fetchrow(ctx.db, ban_code)
             if row is None:
                 return ban_code
 
@@ -340,17 +388,11 @@ class Confession(commands.Cog):
 
     async def _fetch_with_ban_code(self, ctx, guild_id, ban_code):
         """ Fetch confessions with ban code. """
-        query = f"""SELECT *
-                    FROM confessions
-                    WHERE confession_ban_code = $1
-                    AND guild_id = $2
-                """
-
         # Make sure it's valid ban code
         if not self._check_ban_code(ban_code):
             raise commands.UserInputError(f"Given ban code is not valid: **{ban_code}**")
 
-        rows = await ctx.db.fetch(query, ban_code, guild_id)
+        rows = await confession_by_ban_code_query.fetch(ctx.db, ban_code, guild_id)
 
         # Check there is a confession with ban code
         if len(rows) == 0:
@@ -366,17 +408,11 @@ class Confession(commands.Cog):
 
     async def _fetch_warn_with_ban_code(self, ctx, guild_id, ban_code):
         """ Fetch user warns with confession warn code """
-        query = f"""SELECT *
-                    FROM warns
-                    WHERE confession_ban_code = $1
-                    AND guild_id = $2
-                """
-
         # Make sure it's valid ban code
         if not self._check_ban_code(ban_code):
             raise commands.UserInputError(f"Given ban code is not valid: **{ban_code}**")
 
-        return await ctx.db.fetch(query, ban_code, guild_id)
+        return await warns_by_ban_code_query.fetch(ctx.db, ban_code, guild_id)
 
     # async def _delete_with_ban_code(self, ctx, guild_id, ban_code):
     #     """ Delete a confession with ban code."""
@@ -393,14 +429,7 @@ class Confession(commands.Cog):
 
     async def _fetch_with_user_code(self, ctx, guild_id, user_hash_code):
         """ Fetch banned user with ban code """
-        query = f"""SELECT *
-                    FROM bannedusers
-                    WHERE user_hash_id = $1 AND
-                    guild_id = $2
-                """
-        row = await ctx.db.fetchrow(query, user_hash_code, guild_id)
-
-        return row
+        return await self.banned_users.get((user_hash_code, guild_id))
 
     async def _set_ban_status(self, ctx, guild_id: int, user_hash_id: str, ban_status: bool = False):
         """ Set a user ban status for a confession."""
@@ -461,7 +490,8 @@ class Confession(commands.Cog):
         # Okay it should be alright - add em to the cache
         self.currently_confessing.add(author.id)
 
-        guilds = [await helpers.get_guild_by_id(self.bot, guild_id) for guild_id in self.confession_servers_map.keys()]
+        confession_servers = await self.get_confession_server_ids()
+        guilds = [await helpers.get_guild_by_id(self.bot, guild_id) for guild_id in confession_servers.keys()]
         # filter guilds to keep only guild the user in
         guilds = [guild for guild in guilds if await helpers.get_member_by_id(guild, author.id) is not None]
         if len(guilds) == 0:
@@ -494,7 +524,7 @@ class Confession(commands.Cog):
             return await ctx.send('Command has been cancelled.')
 
         # Check guild has the confession channel given in settings
-        channel_id = self.confession_servers_map[guild.id]
+        channel_id = confession_servers[guild.id]
         confession_channel = await helpers.get_channel_by_id(self.bot, guild, channel_id)
         if confession_channel is None:
             self.currently_confessing.discard(author.id)
@@ -633,7 +663,7 @@ class Confession(commands.Cog):
     @commands.guild_only()
     async def get_channel(self, ctx):
         guild = ctx.guild
-        channel_id = self.confession_servers_map.get(guild.id, None)
+        channel_id = await self.confession_channels.get(guild.id)
         if channel_id:
             channel = await helpers.get_channel_by_id(self.bot, guild, channel_id)
             if channel:
@@ -649,13 +679,14 @@ class Confession(commands.Cog):
                            f'if you have required privileges.', delete_after=short_delay)
 
     @confess.command(name='fetchall', help='Fetch all the confession logs from DB for this guild',
-                     usage='<is_deleted>\n\n'
-                           'is_deleted: bool, default False - whether list only deleted records',
+                     usage='<is_deleted> <to_csv>\n\n'
+                           'is_deleted: bool, default False - whether list only deleted records\n'
+                           'to_csv: bool, default False - True for writing the logs to a CSV file',
                      aliases=['fa'])
     @commands.has_permissions(manage_messages=True, ban_members=True)
     @commands.guild_only()
-    async def fetchall(self, ctx, is_deleted: bool = False):
-        query = """SELECT confession_id,
+    async def fetchall(self, ctx, is_deleted: bool = False, to_csv: bool = False):
+        columns = """confession_id,
                     confession_ban_code,
                     user_hash_id,
                     guild_id,
@@ -665,37 +696,37 @@ class Confession(commands.Cog):
                     image_url,
                     attachment_urls,
                     user_banned,
-                    is_deleted
-                    FROM confessions
-                    WHERE guild_id = $1
-                    AND is_deleted=$2
-                    ORDER BY timestamp"""
+                    is_deleted"""
+
+        def format_row(record, number):
+            shorten = textwrap.shorten(record['confession_text'], width=150)
+            return f'**{number}) ID**: {record["confession_id"]} | **BCode**: {record["confession_ban_code"]} | ' \
+                   f'**Deleted?**: {record["is_deleted"]} | **{record["timestamp"]}** -> {shorten}'
 
         sent_messages, sent_navs = [ctx.message], []
         try:
             guild = ctx.guild
-            records = await ctx.db.fetch(query, guild.id, is_deleted)
-            if len(records) == 0:
+            source = KeysetSource(ctx.pool, 'confessions', columns, ('timestamp', 'confession_id'),
+                                  where='guild_id = $1 AND is_deleted = $2', args=(guild.id, is_deleted), per_page=6)
+            row_count = await source.count()
+            if row_count == 0:
                 return await ctx.send('No results found...', delete_after=short_delay)
 
-            nav = pag.EmbedNavigatorFactory(max_lines=20)
-            nav.add_line('**__Confession logs__**')
-            row_num_to_id = {}
-            for index, (_id, ban_code, _, _, _, date, text, _, _, ban_status, is_deleted) in enumerate(records):
-                shorten = textwrap.shorten(text, width=150)
-                line = f'**{index+1}) ID**: {_id} | **BCode**: {ban_code} | **Deleted?**: {is_deleted} | ' \
-                       f'**{date}** -> {shorten}'
-                row_num_to_id[index+1] = _id
-                nav.add_line(line)
-                nav.add_line('**-----------------------------**')
-
-            emb_nav = nav.build(ctx=ctx)
+            emb_nav = LazyEmbedNavigator(ctx, source, lines_page('**__Confession logs__**', format_row),
+                                         await source.page_count())
             emb_nav.start()
             sent_navs.append(emb_nav)
 
+            if to_csv:
+                csv_columns = ['ID', 'Ban code', 'User hash', 'Guild ID', 'Channel ID', 'Date', 'Text', 'Image URL',
+                               'Attachment URLs', 'User banned', 'Deleted']
+                csv_rows = (tuple(record.values()) async for record in source.rows())
+                f, filename = await TabularData.stream_csv(csv_columns, csv_rows, 'confession_logs.csv')
+                sent_messages.append(await ctx.send(content='Confession logs CSV file', file=File(fp=f, filename=filename)))
+
             question = 'Please type the row number for check details otherwise type c'
             try:
-                choice, msg = await helpers.get_multichoice_answer(self.bot, ctx, row_num_to_id, question, timeout=short_delay)
+                choice, msg = await helpers.get_row_number_answer(self.bot, ctx, row_count, question, timeout=short_delay)
                 sent_messages.extend(msg)
             except asyncio.TimeoutError as e:
                 return await ctx.send('Please type in 60 seconds next time.')
@@ -703,7 +734,10 @@ class Confession(commands.Cog):
             if choice is None:
                 return await ctx.send('Command has been cancelled.', delete_after=short_delay)
 
-            record = next((record for record in records if record['confession_id'] == choice), None)
+            record = await source.row(choice)
+            if record is None:
+                return await ctx.send('The record has been removed meanwhile.', delete_after=short_delay)
+
             url = f'URL: <https://discordapp.com/channels/{guild.id}/{record["channel_id"]}/{record["confession_id"]}>'
             e = await self._create_embed(record, is_detailed=True)
             await ctx.send(url, embed=e.to_embed())
@@ -925,6 +959,7 @@ class Confession(commands.Cog):
                 await ctx.db.execute(query, *params)
             except asyncpg.UniqueViolationError as err:
                 log.exception(err)
+            self.banned_users.invalidate((record['user_hash_id'], guild.id))
 
             # Remove the message and update db record as banned
             channel = await helpers.get_channel_by_id(self.bot, guild, record['channel_id'])
@@ -1086,6 +1121,7 @@ class Confession(commands.Cog):
                                   " or you have given wrong user hash code.", delete_after=short_delay)
 
         await ctx.db.execute(query, guild.id, user_hash_code)
+        self.banned_users.invalidate((user_hash_code, guild.id))
         await ctx.send(f"Member with **hash code: {user_hash_code}** has been unbanned for **{guild.name}**.",
                        delete_after=short_delay)
 
@@ -1099,7 +1135,7 @@ class Confession(commands.Cog):
                               f' by {ctx.author.mention}', delete_after=short_delay)
 
         # send the deleted confession to newly set channel instead of the channel in DB
-        confession_channel_id = self.confession_servers_map.get(guild.id, None)
+        confession_channel_id = await self.confession_channels.get(guild.id)
         if confession_channel_id:
             confession_channel = await helpers.get_channel_by_id(self.bot, guild, confession_channel_id)
             if confession_channel:
@@ -1130,38 +1166,33 @@ class Confession(commands.Cog):
     @commands.guild_only()
     @commands.is_owner()
     async def fetch_ban(self, ctx):
-        query = """SELECT user_hash_id,
+        columns = """user_hash_id,
                     guild_id,
                     confession_ban_code,
                     timestamp,
-                    reason
-                    FROM bannedusers
-                    WHERE guild_id = $1"""
+                    reason"""
+
+        def format_row(record, number):
+            return f'**{number}) User Hash code**: {record["user_hash_id"]} | **Guild ID:** {record["guild_id"]}' \
+                   f' **BCode**: {record["confession_ban_code"]} | **{record["timestamp"]}** -> {record["reason"]}'
 
         sent_messages, sent_navs = [ctx.message], []
         try:
             guild = ctx.guild
-            records = await ctx.db.fetch(query, guild.id)
-            if len(records) == 0:
+            source = KeysetSource(ctx.pool, 'bannedusers', columns, 'user_hash_id',
+                                  where='guild_id = $1', args=(guild.id,), per_page=9)
+            row_count = await source.count()
+            if row_count == 0:
                 return await ctx.send('No results found...')
 
-            nav = pag.EmbedNavigatorFactory(max_lines=20)
-            nav.add_line('**__Banned Users__**')
-            row_num_to_code = {}
-            for index, (_id, guild_id, confession_ban_code, date, reason) in enumerate(records):
-                line = f'**{index+1}) User Hash code**: {_id} | **Guild ID:** {guild_id}' \
-                       f' **BCode**: {confession_ban_code} | **{date}** -> {reason}'
-                row_num_to_code[index+1] = confession_ban_code
-                nav.add_line(line)
-                nav.add_line('**-----------------------------**')
-
-            emb_nav = nav.build(ctx=ctx)
+            emb_nav = LazyEmbedNavigator(ctx, source, lines_page('**__Banned Users__**', format_row),
+                                         await source.page_count())
             emb_nav.start()
             sent_navs.append(emb_nav)
 
             question = 'Please type the row number for check details otherwise type c'
             try:
-                choice, msg = await helpers.get_multichoice_answer(self.bot, ctx, row_num_to_code, question, timeout=short_delay)
+                choice, msg = await helpers.get_row_number_answer(self.bot, ctx, row_count, question, timeout=short_delay)
                 sent_messages.extend(msg)
             except asyncio.TimeoutError as e:
                 return await ctx.send('Please type in 60 seconds next time.', delete_after=short_delay)
@@ -1169,7 +1200,10 @@ class Confession(commands.Cog):
             if choice is None:
                 return await ctx.send('Command has been cancelled.', delete_after=short_delay)
 
-            ban_record = next((record for record in records if record['confession_ban_code'] == choice), None)
+            ban_record = await source.row(choice)
+            if ban_record is None:
+                return await ctx.send('The record has been removed meanwhile.', delete_after=short_delay)
+
             record = await self._fetch_with_ban_code(ctx, guild.id, ban_record['confession_ban_code'])
             e = await self._create_embed(record)
             await ctx.send(embed=e.to_embed(), delete_after=short_delay)
@@ -1329,7 +1363,8 @@ class Confession(commands.Cog):
         user_hexdigest = Confession.get_hash_code(str(author.id), n=16)
 
         # Get guilds for that user
-        guilds = [await helpers.get_guild_by_id(self.bot, guild_id) for guild_id in self.confession_servers_map.keys()]
+        confession_servers = await self.get_confession_server_ids()
+        guilds = [await helpers.get_guild_by_id(self.bot, guild_id) for guild_id in confession_servers.keys()]
         # filter guilds to keep only guild the user in
         guilds = [guild for guild in guilds if await helpers.get_member_by_id(guild, author.id) is not None]
 
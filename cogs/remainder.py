@@ -1,14 +1,24 @@
+import collections
 import logging
 import asyncio
 import asyncpg
 import datetime
+import functools
+import heapq
+import json
+import os
+import socket
 import textwrap
 import typing
+import uuid
 
 from discord.ext import commands
 import discord
 
+from config import timer_window_size, timer_dispatch_mode, timer_overdue_policy, timer_catchup_concurrency, \
+    short_timer_journal, timer_listen, timer_lease_seconds, PostgreSQL
 from utils import db, time, formats, helpers
+from utils.timerwheel import TimingWheel
 
 
 class Reminders(db.Table):
@@ -19,6 +29,14 @@ class Reminders(db.Table):
     event = db.Column(db.String)
     extra = db.Column(db.JSON, default="'{}'::jsonb")
 
+    # lease of the worker currently firing the timer in lease dispatch mode
+    leased_until = db.Column(db.Datetime)
+    leased_by = db.Column(db.String)
+
+    # lookups by event, and by event and owner such as the guild or the reminder author
+    event_expires = db.Index('event', 'expires')
+    event_owner_expires = db.Index('event', "(extra #>> '{args,0}')", 'expires')
+
 
 log = logging.getLogger('root')
 
@@ -60,6 +78,17 @@ class Timer:
     def human_delta(self):
         return time.human_timedelta(self.created_at)
 
+    def to_payload(self):
+        """A JSON serialisable form of a temporary timer."""
+        return {'event': self.event, 'args': self.args, 'kwargs': self.kwargs,
+                'created': self.created_at.isoformat(), 'expires': self.expires.isoformat()}
+
+    @classmethod
+    def from_payload(cls, payload):
+        return cls.temporary(event=payload['event'], args=payload['args'], kwargs=payload['kwargs'],
+                             created=datetime.datetime.fromisoformat(payload['created']),
+                             expires=datetime.datetime.fromisoformat(payload['expires']))
+
     def __repr__(self):
         return f'<Timer created={self.created_at} expires={self.expires} event={self.event}>'
 
@@ -70,58 +99,434 @@ class Reminder(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self._have_data = asyncio.Event(loop=bot.loop)
+        # set whenever the head of the heap may have changed so the dispatcher re-arms its sleep
+        self._rearm = asyncio.Event(loop=bot.loop)
         self._current_timer = None
+        # min-heap of (expires, id, timer) entries for the currently loaded dispatch window
+        self._heap = []
+        self._heap_ids = set()
+        # every timer expiring up to this point is tracked by the heap, None while no window is loaded
+        self._window_end = None
+        # lower bound of the next window, timers expiring before it were already handled
+        self._dispatched_until = datetime.datetime.utcnow()
+        # expiry of timers inserted by other connections while a window was loading
+        self._notified = []
+        # dedicated connection listening for timers inserted by other processes
+        self._listener = None
+        # event -> the task firing its latest claimed timers, the next group of the event waits for it
+        self._event_tails = {}
+        # identifies this process on the leases it holds, the PID alone repeats across container restarts
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        # sub-minute timers never reach the database, they live in the timing wheel
+        self._short_timers = TimingWheel(self._on_short_timer, journal=short_timer_journal or None, loop=bot.loop)
+        self.replay_short_timers()
         self._task = bot.loop.create_task(self.dispatch_timers())
+        self._catch_up_task = bot.loop.create_task(self.catch_up_timers())
+        if timer_listen:
+            self._listen_task = bot.loop.create_task(self.listen_for_timers())
+        if timer_dispatch_mode == 'lease':
+            self._sweep_task = bot.loop.create_task(self.sweep_leases())
 
     def cog_unload(self):
         self._task.cancel()
+        self._catch_up_task.cancel()
+        if timer_dispatch_mode == 'lease':
+            self._sweep_task.cancel()
+        self._short_timers.close()
+        if timer_listen:
+            self._listen_task.cancel()
+            self.bot.loop.create_task(self.stop_listening())
 
     async def cog_command_error(self, ctx, error):
         if isinstance(error, commands.BadArgument):
             log.exception(error)
             await ctx.send(error)
 
-    async def get_active_timer(self, *, connection=None, days=7):
-        # query = "SELECT * FROM reminders WHERE expires < (CURRENT_DATE + $1::interval) ORDER BY expires LIMIT 1;"
-        query = "SELECT * FROM reminders WHERE expires BETWEEN NOW() AND " \
-                "(NOW() + $1::interval) ORDER BY expires LIMIT 1;"
+    def _push_timer(self, timer):
+        """Push a timer into the heap unless it is already tracked."""
+        if timer.id in self._heap_ids:
+            return False
+
+        heapq.heappush(self._heap, (timer.expires, timer.id, timer))
+        self._heap_ids.add(timer.id)
+        return True
+
+    async def load_timer_window(self, *, connection=None, days=7):
+        """Loads the next window of timers into the heap with a single query."""
+        # rows under a live lease belong to a worker firing them, loading them again would only spin
+        leased = "AND (leased_until IS NULL OR leased_until <= NOW() AT TIME ZONE 'utc')" \
+            if timer_dispatch_mode == 'lease' else ''
+        query = f"""SELECT * FROM reminders
+                   WHERE expires >= $1 AND expires < $2
+                   {leased}
+                   ORDER BY expires
+                   LIMIT $3;
+                """
         con = connection or self.bot.pool
+        upper = datetime.datetime.utcnow() + datetime.timedelta(days=days)
+
+        self._window_end = None
+        started = self.bot.loop.time()
+        records = await con.fetch(query, self._dispatched_until, upper, timer_window_size)
+        self.record_claim('window', started)
+
+        # a full page means there may be more rows, so the window only reaches the last loaded timer
+        window_end = upper if len(records) < timer_window_size else records[-1]['expires']
+        for record in records:
+            self._push_timer(Timer(record=record))
+
+        # timers merged while the window was loading may lie beyond it, the next window picks them up
+        if any(expires > window_end for expires, _, _ in self._heap):
+            self._heap = [entry for entry in self._heap if entry[0] <= window_end]
+            heapq.heapify(self._heap)
+            self._heap_ids = {timer_id for _, timer_id, _ in self._heap}
 
-        record = await con.fetchrow(query, datetime.timedelta(days=days))
-        return Timer(record=record) if record else None
+        self._window_end = window_end
+
+        notified, self._notified = self._notified, []
+        for expires in notified:
+            self.merge_notified_timer(expires)
+
+        self.bot.metrics.gauge('timer.queue_depth', len(self._heap))
+        return len(records)
+
+    async def get_active_timer(self, *, connection=None, days=7):
+        if self._window_end is None or not self._heap:
+            await self.load_timer_window(connection=connection, days=days)
+
+        return self._heap[0][2] if self._heap else None
 
     async def wait_for_active_timers(self, *, connection=None, days=7):
-        async with db.MaybeAcquire(connection=connection, pool=self.bot.pool) as con:
-            timer = await self.get_active_timer(connection=con, days=days)
+        while True:
+            self._have_data.clear()
+            async with db.MaybeAcquire(connection=connection, pool=self.bot.pool) as con:
+                timer = await self.get_active_timer(connection=con, days=days)
+
             if timer is not None:
                 self._have_data.set()
                 return timer
 
-            self._have_data.clear()
             self._current_timer = None
             await self._have_data.wait()
-            return await self.get_active_timer(connection=con, days=days)
+
+    def record_claim(self, mode, started):
+        """Records the DB time of a timer claim started at the given loop time."""
+        self.bot.metrics.observe('timer.claim_seconds', self.bot.loop.time() - started, mode=mode)
+
+    def dispatch_timer(self, timer):
+        self.bot.loop.create_task(self.fire_listeners(timer))
 
     async def call_timer(self, timer):
         # delete the timer
         query = "DELETE FROM reminders WHERE id=$1;"
-        await self.bot.pool.execute(query, timer.id)
+        started = self.bot.loop.time()
+        status = await self.bot.pool.execute(query, timer.id)
+        self.record_claim('single', started)
+
+        # the timer was removed from the table after it had been loaded into the heap
+        if status == 'DELETE 0':
+            return
 
         # dispatch the event
-        event_name = f'{timer.event}_timer_complete'
-        self.bot.dispatch(event_name, timer)
+        self.dispatch_timer(timer)
+
+    async def call_timers(self, now):
+        """Claims every timer due by ``now`` with a single query and dispatches them.
+
+        Timers of the same event fire one after another in expiry order,
+        different events are fanned out at once.
+        """
+        query = """DELETE FROM reminders
+                   WHERE expires >= $1 AND expires <= $2
+                   RETURNING *;
+                """
+        started = self.bot.loop.time()
+        records = await self.bot.pool.fetch(query, self._dispatched_until, now)
+        self.record_claim('batch', started)
+        timers = sorted((Timer(record=record) for record in records), key=lambda t: (t.expires, t.id))
+
+        # every due heap entry was claimed above or deleted by someone else in the meantime
+        while self._heap and self._heap[0][0] <= now:
+            _, timer_id, _ = heapq.heappop(self._heap)
+            self._heap_ids.discard(timer_id)
+
+        if not timers:
+            return 0
+
+        self._dispatched_until = timers[-1].expires
+        batch = collections.Counter(timer.event for timer in timers)
+        log.debug('Claimed %s timers in one batch: %s', len(timers),
+                  ', '.join(f'{event}={count}' for event, count in batch.items()))
+        self.bot.metrics.increment('timer.claimed', len(timers), mode='batch')
+
+        self.fire_timers(timers)
+        return len(timers)
+
+    async def lease_timers(self, now):
+        """Claims due timers with a lease so that several workers can share the table.
+
+        Rows locked by another worker are skipped and rows whose lease ran
+        out are claimed again, even if they expired before this worker started.
+        Rows leased by this worker are never claimed again, their leases are
+        renewed until their listeners are done and the timers are deleted.
+        """
+        query = """WITH due AS (
+                       SELECT id FROM reminders
+                       WHERE expires <= $1
+                       AND (expires >= $2 OR leased_until IS NOT NULL)
+                       AND (leased_until IS NULL OR leased_until < $1)
+                       AND leased_by IS DISTINCT FROM $5
+                       ORDER BY expires
+                       LIMIT $3
+                       FOR UPDATE SKIP LOCKED
+                   )
+                   UPDATE reminders AS r
+                   SET leased_until = $1 + $4::interval, leased_by = $5
+                   FROM due
+                   WHERE r.id = due.id
+                   RETURNING r.*;
+                """
+        lease = datetime.timedelta(seconds=timer_lease_seconds)
+
+        total = 0
+        while True:
+            started = self.bot.loop.time()
+            records = await self.bot.pool.fetch(query, now, self._dispatched_until, timer_window_size,
+                                                lease, self.worker_id)
+            self.record_claim('lease', started)
+            timers = sorted((Timer(record=record) for record in records), key=lambda t: (t.expires, t.id))
+            if timers:
+                self._dispatched_until = max(self._dispatched_until, timers[-1].expires)
+                self.bot.loop.create_task(self.complete_leased_timers(timers))
+                total += len(timers)
+
+            if len(records) < timer_window_size:
+                break
+
+        while self._heap and self._heap[0][0] <= now:
+            _, timer_id, _ = heapq.heappop(self._heap)
+            self._heap_ids.discard(timer_id)
+
+        if total:
+            log.debug(f'Leased {total} timers as {self.worker_id}.')
+        return total
+
+    async def _fire_group(self, previous, group):
+        if previous is not None:
+            # only waits, a failed group must not stop the next one
+            await asyncio.wait([previous])
+        for timer in group:
+            await self.fire_listeners(timer)
+
+    def _release_tail(self, event, task):
+        if self._event_tails.get(event) is task:
+            del self._event_tails[event]
+
+    def fire_timers(self, timers):
+        """Fires timers in the background, returns a future done once all of them are.
+
+        Timers of the same event run one after another in the given order, also
+        after the timers of that event claimed before them. Different events run
+        concurrently.
+        """
+        by_event = collections.defaultdict(list)
+        for timer in timers:
+            by_event[timer.event].append(timer)
+
+        tasks = []
+        for event, group in by_event.items():
+            task = self.bot.loop.create_task(self._fire_group(self._event_tails.get(event), group))
+            task.add_done_callback(functools.partial(self._release_tail, event))
+            self._event_tails[event] = task
+            tasks.append(task)
+
+        return asyncio.gather(*tasks)
+
+    async def renew_leases(self, timer_ids):
+        """Extends the leases of the given timers every third of the lease time until cancelled."""
+        query = "UPDATE reminders SET leased_until = $1 WHERE id = ANY($2::int[]) AND leased_by = $3;"
+        lease = datetime.timedelta(seconds=timer_lease_seconds)
+        while True:
+            await asyncio.sleep(timer_lease_seconds / 3)
+            try:
+                await self.bot.pool.execute(query, datetime.datetime.utcnow() + lease, timer_ids, self.worker_id)
+            except (OSError, asyncpg.PostgresError) as e:
+                log.warning(f'Could not renew timer leases: {e}')
+
+    async def complete_leased_timers(self, timers):
+        """Fires leased timers and deletes them once every listener is done.
+
+        The leases are renewed while the listeners run, so a listener running
+        longer than the lease does not get its timer claimed and fired again.
+        """
+        query = "DELETE FROM reminders WHERE id = ANY($1::int[]) AND leased_by = $2;"
+        timer_ids = [timer.id for timer in timers]
+
+        heartbeat = self.bot.loop.create_task(self.renew_leases(timer_ids))
+        try:
+            await self.fire_timers(timers)
+        finally:
+            heartbeat.cancel()
+        await self.bot.pool.execute(query, timer_ids, self.worker_id)
+
+    async def sweep_leases(self):
+        """Periodically claims timers whose lease ran out on a dead worker."""
+        await self.bot.wait_until_ready()
+        while not self.bot.is_closed():
+            await asyncio.sleep(timer_lease_seconds)
+            try:
+                await self.lease_timers(datetime.datetime.utcnow())
+            except (OSError, asyncpg.PostgresError) as e:
+                log.warning(f'Could not sweep timer leases: {e}')
+
+    async def fire_due_timers(self):
+        """Fires every timer in the heap that is due by now in one pass."""
+        now = datetime.datetime.utcnow()
+        if timer_dispatch_mode == 'batch':
+            await self.call_timers(now)
+        elif timer_dispatch_mode == 'lease':
+            await self.lease_timers(now)
+        else:
+            while self._heap and self._heap[0][0] <= now:
+                expires, timer_id, timer = heapq.heappop(self._heap)
+                self._heap_ids.discard(timer_id)
+                self._dispatched_until = expires
+                await self.call_timer(timer)
+
+        self.bot.metrics.gauge('timer.queue_depth', len(self._heap))
 
     def cancel_current_timer(self, timer_ids: typing.Optional[list] = None):
-        """ Cancel current timer if the ID is correct if given else cancel it directly"""
-        is_cancel_timer = True if timer_ids is None else (True if self._current_timer.id in timer_ids else False)
-        if self._current_timer and is_cancel_timer:
-            self._task.cancel()
-            self._task = self.bot.loop.create_task(self.dispatch_timers())
+        """ Drop the given timers from the heap if IDs are given else reload the whole window"""
+        if timer_ids is None:
+            self._heap.clear()
+            self._heap_ids.clear()
+            self._window_end = None
+        else:
+            removed = self._heap_ids.intersection(timer_ids)
+            if not removed:
+                return
+
+            self._heap = [entry for entry in self._heap if entry[1] not in removed]
+            heapq.heapify(self._heap)
+            self._heap_ids.difference_update(removed)
+
+        self._rearm.set()
+
+    def merge_notified_timer(self, expires):
+        """Makes sure a timer inserted by another connection is dispatched in time.
+
+        Timers inside the loaded window that are not in the heap cut the window
+        short, so everything from their expiry on is loaded again. The dispatcher
+        only re-arms if the new timer is earlier than the current head.
+        """
+        if self._window_end is None:
+            self._notified.append(expires)
+            return
+
+        if (expires - datetime.datetime.utcnow()).total_seconds() <= (86400 * 40):  # 40 days
+            self._have_data.set()
+
+        if expires > self._window_end or any(entry[0] == expires for entry in self._heap):
+            return
+
+        self._window_end = expires
+        if any(entry[0] > expires for entry in self._heap):
+            self._heap = [entry for entry in self._heap if entry[0] <= expires]
+            heapq.heapify(self._heap)
+            self._heap_ids = {timer_id for _, timer_id, _ in self._heap}
+
+        if not self._heap or expires < self._heap[0][0]:
+            self._rearm.set()
+
+    def _on_timer_notification(self, connection, pid, channel, payload):
+        try:
+            expires = datetime.datetime.fromisoformat(payload)
+        except ValueError:
+            return log.warning(f'Invalid payload on {channel} channel: {payload}')
+
+        self.merge_notified_timer(expires)
+
+    async def listen_for_timers(self):
+        """Holds a dedicated connection that LISTENs for timers inserted by any process.
+
+        A lost connection is opened again and the timer window is reloaded,
+        so the timers inserted while it was down are not missed.
+        """
+        # one notification per INSERT statement with the earliest expiry it inserted,
+        # always with six fraction digits as fromisoformat of Python 3.7 only accepts three or six
+        query = """CREATE OR REPLACE FUNCTION reminders_notify() RETURNS trigger AS $$
+                   BEGIN
+                       PERFORM pg_notify('reminders', (SELECT to_char(MIN(expires), 'YYYY-MM-DD"T"HH24:MI:SS.US')
+                                                       FROM inserted));
+                       RETURN NULL;
+                   END;
+                   $$ LANGUAGE plpgsql;
+
+                   DO $$
+                   BEGIN
+                       IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'reminders_notify_trigger') THEN
+                           CREATE TRIGGER reminders_notify_trigger
+                           AFTER INSERT ON reminders
+                           REFERENCING NEW TABLE AS inserted
+                           FOR EACH STATEMENT EXECUTE PROCEDURE reminders_notify();
+                       END IF;
+                   END;
+                   $$;
+                """
+        await self.bot.wait_until_ready()
+        try:
+            await self.bot.pool.execute(query)
+        except asyncpg.PostgresError as e:
+            log.warning(f'Could not create the reminders notify trigger: {e}')
+
+        retry, reconnecting = 1, False
+        while not self.bot.is_closed():
+            lost = asyncio.Event()
+            try:
+                # not taken from the pool, it is held for as long as the bot runs
+                self._listener = await asyncpg.connect(PostgreSQL.return_connection_str())
+                self._listener.add_termination_listener(lambda connection: lost.set())
+                await self._listener.add_listener('reminders', self._on_timer_notification)
+                if reconnecting:
+                    # notifications sent while the connection was down are lost, the window is loaded again
+                    await self.load_timer_window(days=40)
+                    self._have_data.set()
+                    self._rearm.set()
+            except (OSError, asyncpg.PostgresError) as e:
+                log.warning(f'Could not listen for timers, retrying in {retry} seconds: {e}')
+                await self.stop_listening()
+                await asyncio.sleep(retry)
+                retry, reconnecting = min(retry * 2, 60), True
+                continue
+
+            retry, reconnecting = 1, True
+            await lost.wait()
+            self._listener = None
+            log.warning('The timer listener connection has been lost, reconnecting.')
+
+    async def stop_listening(self):
+        if self._listener is None:
+            return
+
+        listener, self._listener = self._listener, None
+        try:
+            await listener.close(timeout=5)
+        except (OSError, asyncpg.PostgresError, asyncio.TimeoutError):
+            listener.terminate()
+
+    async def _wait_for_rearm(self, seconds):
+        """Sleeps for the given seconds, returns ``True`` if the heap head changed in the meantime."""
+        try:
+            await asyncio.wait_for(self._rearm.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            return False
+        return True
 
     async def dispatch_timers(self):
         try:
             await self.bot.wait_until_ready()
             while not self.bot.is_closed():
+                self._rearm.clear()
                 # can only asyncio.sleep for up to ~48 days reliably
                 # so we're gonna cap it off at 40 days
                 # see: http://bugs.python.org/issue20493
@@ -129,19 +534,144 @@ class Reminder(commands.Cog):
                 now = datetime.datetime.utcnow()
                 if timer.expires >= now:
                     to_sleep = (timer.expires - now).total_seconds()
-                    await asyncio.sleep(to_sleep)
+                    if await self._wait_for_rearm(to_sleep):
+                        continue
 
-                await self.call_timer(timer)
+                await self.fire_due_timers()
         except asyncio.CancelledError:
             raise
         except (OSError, discord.ConnectionClosed, asyncpg.PostgresConnectionError):
             self._task.cancel()
             self._task = self.bot.loop.create_task(self.dispatch_timers())
 
-    async def short_timer_optimisation(self, seconds, timer):
-        await asyncio.sleep(seconds)
-        event_name = f'{timer.event}_timer_complete'
-        self.bot.dispatch(event_name, timer)
+    async def _run_listener(self, listener, event_name, timer):
+        cog = getattr(listener, '__self__', None)
+        db.query_tags.set((cog.qualified_name if isinstance(cog, commands.Cog) else '-', event_name))
+        started = self.bot.loop.time()
+        try:
+            await listener(timer)
+        except Exception:
+            log.exception(f'Listener {event_name} has failed for timer {timer.id}.')
+        finally:
+            self.bot.metrics.observe('timer.handler_seconds', self.bot.loop.time() - started,
+                                     listener=listener.__qualname__)
+
+    async def fire_listeners(self, timer):
+        """Dispatches a timer event and runs its cog listeners directly so the caller can wait for them."""
+        event_name = f'on_{timer.event}_timer_complete'
+        lag = (datetime.datetime.utcnow() - timer.expires).total_seconds()
+        self.bot.metrics.observe('timer.lag_seconds', max(lag, 0.0), event=timer.event)
+
+        # wait_for and the on_ methods of the bot get the event as before
+        listeners = self.bot.dispatch_awaitable(f'{timer.event}_timer_complete', timer)
+        await asyncio.gather(*(self._run_listener(listener, event_name, timer) for listener in listeners))
+
+    @staticmethod
+    def _coalesce_key(timer):
+        # the owner is keyed like in the event_owner_expires index
+        owner = timer.args[0] if timer.args else None
+        return timer.event, json.dumps(owner, sort_keys=True)
+
+    async def catch_up_timers(self, *, chunk_size=100):
+        """Handles the timers that expired while the bot was down.
+
+        Overdue timers are streamed in expiry order and handled by the
+        policy of their event in ``timer_overdue_policy``:
+
+        - fire: dispatch every overdue timer
+        - drop: delete them without dispatching
+        - coalesce: dispatch only the latest one of each owner and delete the rest,
+          the owner is the first argument of the timer such as the guild or the member
+
+        At most ``timer_catchup_concurrency`` listeners run at the same time.
+        """
+        if not timer_overdue_policy:
+            return
+
+        # the lease columns only exist once the lease migration ran, which other modes do not need
+        leased = 'AND (leased_until IS NULL OR leased_until < $1)' if timer_dispatch_mode == 'lease' else ''
+        query = f"""SELECT * FROM reminders
+                   WHERE expires < $1 AND event = ANY($2::text[])
+                   {leased}
+                   ORDER BY expires;
+                """
+        # another worker may be catching up at the same time, only the rows we delete are ours
+        delete_query = "DELETE FROM reminders WHERE id = ANY($1::int[]) RETURNING id;"
+
+        semaphore = asyncio.Semaphore(timer_catchup_concurrency)
+        stats = collections.Counter()
+        to_fire, to_drop = [], []
+        coalesced = {}
+
+        async def fire(timer):
+            async with semaphore:
+                await self.fire_listeners(timer)
+
+        async def flush():
+            if to_fire or to_drop:
+                started = self.bot.loop.time()
+                deleted = await self.bot.pool.fetch(delete_query, [timer.id for timer in to_fire] + to_drop)
+                self.record_claim('catchup', started)
+                deleted = {record['id'] for record in deleted}
+                to_fire[:] = [timer for timer in to_fire if timer.id in deleted]
+                stats['fire'] += len(to_fire)
+                stats['drop'] += len(deleted) - len(to_fire)
+
+            await asyncio.gather(*(fire(timer) for timer in to_fire))
+            to_fire.clear()
+            to_drop.clear()
+
+        await self.bot.wait_until_ready()
+        async with self.bot.pool.acquire() as con:
+            async with con.transaction():
+                async for record in con.cursor(query, self._dispatched_until, list(timer_overdue_policy)):
+                    timer = Timer(record=record)
+                    policy = timer_overdue_policy[timer.event]
+                    if policy == 'fire':
+                        to_fire.append(timer)
+                    elif policy == 'coalesce':
+                        key = self._coalesce_key(timer)
+                        previous = coalesced.get(key)
+                        if previous is not None:
+                            to_drop.append(previous.id)
+                        coalesced[key] = timer
+                    elif policy == 'drop':
+                        to_drop.append(timer.id)
+
+                    if len(to_fire) + len(to_drop) >= chunk_size:
+                        await flush()
+
+        to_fire.extend(coalesced.values())
+        await flush()
+
+        if stats:
+            log.info(f'Overdue timers have been caught up, fired: {stats["fire"]}, dropped: {stats["drop"]}.')
+
+    async def _dispatch_when_ready(self, timer):
+        await self.bot.wait_until_ready()
+        self.dispatch_timer(timer)
+
+    def _on_short_timer(self, payload):
+        timer = Timer.from_payload(payload)
+        if self.bot.is_ready():
+            self.dispatch_timer(timer)
+        else:
+            # replayed timers may expire before the bot is connected
+            self.bot.loop.create_task(self._dispatch_when_ready(timer))
+
+    def add_short_timer(self, timer):
+        """Puts a sub-minute timer in the timing wheel."""
+        expires = timer.expires.replace(tzinfo=datetime.timezone.utc).timestamp()
+        self._short_timers.add(uuid.uuid4().hex, expires, timer.to_payload())
+
+    def replay_short_timers(self):
+        """Re-arms the short timers journaled before the last restart, overdue ones fire right away."""
+        entries = self._short_timers.replay()
+        for key, expires, payload in entries:
+            self._short_timers.add(key, expires, payload)
+
+        if entries:
+            log.info(f'{len(entries)} short timers have been restored from the journal.')
 
     async def create_timer(self, *args, **kwargs):
         """Creates a timer.
@@ -184,38 +714,98 @@ class Reminder(commands.Cog):
         except KeyError:
             now = datetime.datetime.utcnow()
 
-        timer = Timer.temporary(event=event, args=args, kwargs=kwargs, expires=when, created=now)
-        delta = (when - now).total_seconds()
-        if delta <= 60:
-            # a shortcut for small timers
-            self.bot.loop.create_task(self.short_timer_optimisation(delta, timer))
-            return timer
+        timers = await self.create_timers([(when, event, args, kwargs)], connection=connection, created=now)
+        return timers[0]
+
+    async def create_timers(self, timers, *, connection=None, created=None):
+        """Creates many timers with a single query.
+
+        Sub-minute timers go to the timing wheel, the rest are inserted with
+        one multi-row INSERT and the dispatcher is re-armed at most once.
+
+        Parameters
+        -----------
+        timers: Iterable[Tuple[datetime.datetime, str, list, dict]]
+            ``(when, event, args, kwargs)`` tuples, see :meth:`create_timer`.
+            ``kwargs`` can be omitted.
+        connection: asyncpg.Connection
+            The connection to use for the DB request.
+        created: datetime.datetime
+            The creation time of every timer.
+
+        Returns
+        --------
+        List[:class:`Timer`]
+            The timers in the given order, with their IDs set.
+        """
+        connection = connection or self.bot.pool
+        now = created or datetime.datetime.utcnow()
+
+        result, to_insert = [], []
+        for when, event, args, *rest in timers:
+            kwargs = rest[0] if rest else {}
+            timer = Timer.temporary(event=event, args=list(args), kwargs=kwargs, expires=when, created=now)
+            result.append(timer)
+
+            if (when - now).total_seconds() <= 60:
+                # a shortcut for small timers
+                self.add_short_timer(timer)
+            else:
+                to_insert.append(timer)
+
+        if not to_insert:
+            return result
 
         query = """INSERT INTO reminders (event, extra, expires, created)
-                   VALUES ($1, $2::jsonb, $3, $4)
+                   SELECT t.event, t.extra::jsonb, t.expires, t.created
+                   FROM unnest($1::text[], $2::text[], $3::timestamp[], $4::timestamp[])
+                   WITH ORDINALITY AS t(event, extra, expires, created, ord)
+                   ORDER BY t.ord
                    RETURNING id;
                 """
 
-        row = await connection.fetchrow(query, event, {'args': args, 'kwargs': kwargs}, when, now)
+        records = await connection.fetch(query, [timer.event for timer in to_insert],
+                                         [json.dumps({'args': timer.args, 'kwargs': timer.kwargs})
+                                          for timer in to_insert],
+                                         [timer.expires for timer in to_insert],
+                                         [timer.created_at for timer in to_insert])
 
-        timer.id = row[0]
+        for timer, record in zip(to_insert, records):
+            timer.id = record['id']
+
+        # merge the timers into the loaded window, later timers are picked up by the next window
+        head = self._heap[0][0] if self._heap else None
+        rearm = False
+        for timer in to_insert:
+            if self._window_end is None or timer.expires <= self._window_end:
+                if self._push_timer(timer) and (head is None or timer.expires < head):
+                    rearm = True
+
+        if rearm:
+            self._rearm.set()
 
         # only set the data check if it can be waited on
-        if delta <= (86400 * 40):  # 40 days
+        if min((timer.expires - now).total_seconds() for timer in to_insert) <= (86400 * 40):  # 40 days
             self._have_data.set()
 
-        # check if this timer is earlier than our currently run timer
-        if self._current_timer and when < self._current_timer.expires:
-            # cancel the task and re-run it
-            self._task.cancel()
-            self._task = self.bot.loop.create_task(self.dispatch_timers())
-
-        return timer
+        return result
 
     @commands.group(name='reminder', aliases=['timer', 'remind'], help='Command group for reminder', hidden=True)
     async def reminder(self, ctx):
         pass
 
+    @reminder.command(name='stats', help='Shows timer dispatch latency and backlog metrics.', hidden=True)
+    @commands.is_owner()
+    async def reminder_stats(self, ctx):
+        """Shows timer dispatch latency and backlog metrics."""
+        self.bot.metrics.gauge('timer.short_pending', len(self._short_timers))
+        try:
+            text = self.bot.metrics.format(prefix='timer.')
+        except AttributeError:
+            return await ctx.send('The current metrics sink does not support reporting.')
+
+        await ctx.safe_send(f'```\n{text or "No timer metrics yet."}\n```', escape_mentions=False)
+
     @reminder.command(name='create',
                       help='Create a reminder that reminds you of something after a certain amount of time',
                       usage='<when> \n The input can be any direct date (e.g. YYYY-MM-DD) or a human readable offset.\n'
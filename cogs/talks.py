@@ -23,6 +23,8 @@ from discord import File, TextChannel, Guild, InvalidArgument, Forbidden, HTTPEx
 import logging
 from config import VALID_STATS_ROLES, ADMIN_ROLE_NAMES, GUILD_ID, message_timeout, warn_limit, command_cooldown
 from utils import db, helpers
+from utils.cache import TTLCache
+from utils.paging import KeysetSource, LazyEmbedNavigator, lines_page
 from utils.formats import CustomEmbed
 from libneko import pag
 
@@ -63,6 +65,39 @@ class Talks(db.Table):
               "ON DELETE CASCADE ON UPDATE CASCADE);"
         return statement[:-2] + ',' + sql
 
+
+guild_themes_query = db.Query('talks_guild_themes', """
+    SELECT * FROM themes
+    WHERE guild_id = $1
+""")
+
+guild_talks_query = db.Query('talks_guild_talks', """
+    SELECT * FROM talks
+    WHERE guild_id = $1
+""")
+
+# the talk listing is paged with a KeysetSource over these clauses
+talk_details_columns = """
+    talk_id, talks.guild_id AS guild_id, talk_topic, talk_explanation, additional_links,
+    talks.created_by AS by, talks.timestamp AS creation_time,
+    themes.theme_id AS theme_id, theme_name, theme_explanation
+"""
+talk_details_from = """
+    talks INNER JOIN themes ON talks.theme_id = themes.theme_id AND talks.guild_id = themes.guild_id
+"""
+
+# $2 is the theme id or null for any theme
+random_talk_query = db.Query('talks_random_talk', """
+    SELECT talk_id, talks.guild_id AS guild_id, talk_topic, talk_explanation, additional_links,
+    talks.created_by AS by, talks.timestamp AS creation_time,
+    themes.theme_id AS theme_id, theme_name, theme_explanation FROM talks
+    INNER JOIN themes ON talks.theme_id = themes.theme_id AND talks.guild_id = themes.guild_id
+    WHERE talks.guild_id = $1
+    AND ($2::BIGINT is null or talks.theme_id = $2)
+    ORDER BY RANDOM()
+    LIMIT 1
+""")
+
 def wrapper_text_msg(context, is_empty=False):
     """
     Wrapper for wait_for predicate. It return c or - or any text with at least one letter.
@@ -87,6 +122,8 @@ class _Talks(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
+        # guild id -> theme records of the guild
+        self.guild_themes = TTLCache(lambda guild_id: guild_themes_query.fetch(self.bot.pool, guild_id))
 
     # ********** theme command group **********************
     @commands.group(name='theme', help='Command group for themes',
@@ -162,6 +199,8 @@ class _Talks(commands.Cog):
             await ctx.db.execute(query, *query_params)
         except asyncpg.UniqueViolationError:
             return await channel.send(f'The theme: **{theme_name}** has already in the system.')
+        finally:
+            self.guild_themes.invalidate(guild.id)
 
     async def _list_and_get_theme(self, ctx, guild: Guild, question: str = None, any_theme: bool = False):
         """
@@ -170,10 +209,7 @@ class _Talks(commands.Cog):
         if question is not given.
         If question is not None and any_theme is True, the first option is Any theme, which return -1 if selected by user
         """
-        query = 'SELECT * from themes ' \
-                'WHERE guild_id = $1'
-
-        records = await self.bot.pool.fetch(query, guild.id)
+        records = await self.guild_themes.get(guild.id)
         if len(records) == 0:
             raise ValueError('No theme found')
 
@@ -243,6 +279,7 @@ class _Talks(commands.Cog):
                  """
 
         await ctx.db.execute(query, ctx.guild.id, theme_id)
+        self.guild_themes.invalidate(ctx.guild.id)
 
     # ********** talks command group **********************
     @commands.group(name='talks', help='Command group for talks',
@@ -395,44 +432,37 @@ class _Talks(commands.Cog):
     @commands.has_permissions(manage_messages=True, manage_channels=True)
     @commands.guild_only()
     async def fetch_all_talk(self, ctx):
-        query = 'SELECT talk_id, talks.guild_id AS guild_id, talk_topic, talk_explanation, additional_links,' \
-                'talks.created_by AS by, talks.timestamp AS creation_time, ' \
-                'themes.theme_id AS theme_id, theme_name, theme_explanation FROM talks ' \
-                'INNER JOIN themes ON talks.theme_id = themes.theme_id AND talks.guild_id = themes.guild_id ' \
-                'WHERE talks.guild_id = $1'
-
         guild = ctx.guild
-        records = await self.bot.pool.fetch(query, guild.id)
-        if len(records) == 0:
+        source = KeysetSource(self.bot.pool, talk_details_from, talk_details_columns, 'talks.talk_id',
+                              where='talks.guild_id = $1', args=(guild.id,), per_page=5)
+        row_count = await source.count()
+        if row_count == 0:
             return await ctx.send('No talk topic found...')
 
-        nav = pag.EmbedNavigatorFactory(max_lines=20)
-        row_num_to_id = {}
-        nav.add_line('**__Talks__**')
-        for index, (talk_id, _, talk_topic, talk_exp, _, by, date, _, theme_name, _) in enumerate(records):
-            shorten = textwrap.shorten(talk_exp, width=150)
-            member = await helpers.get_member_by_id(guild, by)
+        async def format_row(record, number):
+            shorten = textwrap.shorten(record['talk_explanation'], width=150)
+            member = await helpers.get_member_by_id(guild, record['by'])
             member_text = member.mention if member else "Anonymous"
-            line = f'**{index + 1}) Talk ID**: {talk_id} | **{date.strftime("%Y-%m-%d")}**\n' \
-                   f'**Talk topic**: {talk_topic}\n' \
+            return f'**{number}) Talk ID**: {record["talk_id"]} | **{record["creation_time"].strftime("%Y-%m-%d")}**\n' \
+                   f'**Talk topic**: {record["talk_topic"]}\n' \
                    f'**Exp**: {shorten}\n' \
                    f'**Talk author**: {member_text}'
-            row_num_to_id[index + 1] = talk_id
-            nav.add_line(line)
-            nav.add_line('**-----------------------------**')
 
-        nav.start(ctx=ctx)
+        LazyEmbedNavigator(ctx, source, lines_page('**__Talks__**', format_row), await source.page_count()).start()
 
         question = 'Please type the row number for check details otherwise type c'
         try:
-            selected_talk_id, _ = await helpers.get_multichoice_answer(self.bot, ctx, row_num_to_id, question, timeout=60)
+            choice, _ = await helpers.get_row_number_answer(self.bot, ctx, row_count, question, timeout=60)
         except asyncio.TimeoutError:
             return await ctx.send('Please type in 60 seconds next time.')
 
-        if selected_talk_id is None:
+        if choice is None:
             return await ctx.send('Command has been cancelled.')
 
-        record = next((record for record in records if record['talk_id'] == selected_talk_id), None)
+        record = await source.row(choice)
+        if record is None:
+            return await ctx.send('The talk topic has been removed meanwhile.')
+
         links = json.loads(record['additional_links'])
         member = await helpers.get_member_by_id(guild, record['by'])
         member_text = member.mention if member else "Anonymous"
@@ -463,18 +493,9 @@ class _Talks(commands.Cog):
         except asyncio.TimeoutError:
             return await ctx.send('The command has timed out')
 
-        query = 'SELECT talk_id, talks.guild_id AS guild_id, talk_topic, talk_explanation, additional_links,' \
-                'talks.created_by AS by, talks.timestamp AS creation_time, ' \
-                'themes.theme_id AS theme_id, theme_name, theme_explanation FROM talks ' \
-                'INNER JOIN themes ON talks.theme_id = themes.theme_id AND talks.guild_id = themes.guild_id ' \
-                'WHERE talks.guild_id = $1' \
-                'AND ($2::BIGINT is null or talks.theme_id = $2)' \
-                'ORDER BY RANDOM()' \
-                'LIMIT 1'
-
         guild = ctx.guild
         theme_id = None if theme_id == -1 else theme_id
-        record = await ctx.db.fetchrow(query, guild.id, theme_id)
+        record = await random_talk_query.fetchrow(ctx.db, guild.id, theme_id)
 
         if record is None:
             return await ctx.send('No talk topic found... You can change your theme or select any theme option.')
@@ -500,11 +521,8 @@ class _Talks(commands.Cog):
     @commands.has_permissions(manage_messages=True, manage_channels=True)
     @commands.guild_only()
     async def delete_talk(self, ctx):
-        query = 'SELECT * FROM talks ' \
-                'WHERE guild_id = $1'
-
         guild = ctx.guild
-        records = await self.bot.pool.fetch(query, guild.id)
+        records = await guild_talks_query.fetch(self.bot.pool, guild.id)
         if len(records) == 0:
             return await ctx.send('No talks found to delete')
 
@@ -150,6 +150,22 @@ base_json_dir = 'json_templates'
 short_delay = Config.get_conf_key('main', "short_delay", 60, value_type='int')
 mid_delay = Config.get_conf_key('main', "mid_delay", 120, value_type='int')
 long_delay = Config.get_conf_key('main', "long_delay", 300, value_type='int')
+# seconds the changes of the prefix and blacklist files are coalesced before they are written, 0 writes at once
+config_write_delay = Config.get_conf_key('main', "config_write_delay", 2.0, value_type='float') or None
+# whether the prefix and blacklist files append their changes to a journal instead of being rewritten
+config_journal = Config.get_conf_key('main', "config_journal", True, value_type='bool')
+# extensions without listeners that are loaded after the bot is ready or when one of their commands is used
+lazy_extensions = [ext for ext in Config.get_conf_key('main', "lazy_extensions", [], value_type='list') if ext]
+
+# #### Gateway event recorder #########
+# number of gateway frames summarized in the ring buffer
+event_ring_size = Config.get_conf_key('gateway', "ring_size", 1024, value_type='int')
+# share of the frames whose full payload is kept, RECONNECT and INVALID_SESSION payloads are always kept
+event_sample_rate = Config.get_conf_key('gateway', "sample_rate", 0.0, value_type='float')
+# binary file the frames are dumped to on shutdown, empty to disable
+event_dump_file = Config.get_conf_key('gateway', "dump_file", 'prev_events.bin')
+# number of previous dumps kept as dump_file.1, dump_file.2, ...
+event_dump_backups = Config.get_conf_key('gateway', "dump_backups", 5, value_type='int')
 
 # #### Confession cog #########
 message_timeout = Config.get_conf_key('confession', "message_timeout", 600, value_type='int')
@@ -173,6 +189,31 @@ start_game_delay = Config.get_conf_key('cameradice', "start_game_delay", 10, val
 base_truthdare_dir = 'truthdare'
 ##############################
 
+# #### Reminder cog ##########
+# maximum number of timers loaded into the dispatcher heap with a single query
+timer_window_size = Config.get_conf_key('reminder', "window_size", 100, value_type='int')
+# single: one DELETE per fired timer, batch: one DELETE ... RETURNING for every due timer,
+# lease: claim due timers with FOR UPDATE SKIP LOCKED leases so several workers can share the table
+timer_dispatch_mode = Config.get_conf_key('reminder', "dispatch_mode", 'batch')
+# what to do with timers that expired while the bot was down, as event:policy pairs (fire, drop or coalesce)
+# events without a policy are left in the table, e.g. schedule events are handled by the admin cog
+timer_overdue_policy = {event.strip(): policy.strip() for event, _, policy in (
+    item.partition(':') for item in Config.get_conf_key('reminder', "overdue_policy",
+                                                        ['reminder:fire', 'role_upgrade:coalesce'], value_type='list'))}
+_unknown_policies = set(timer_overdue_policy.values()) - {'fire', 'drop', 'coalesce'}
+if _unknown_policies:
+    raise ValueError(f'Unknown reminder overdue_policy values: {", ".join(sorted(_unknown_policies))}, '
+                     f'use fire, drop or coalesce.')
+# max number of overdue timers fired at the same time on startup
+timer_catchup_concurrency = Config.get_conf_key('reminder', "catchup_concurrency", 5, value_type='int')
+# file that journals sub-minute timers so that they survive a restart, empty to keep them in memory only
+short_timer_journal = Config.get_conf_key('reminder', "short_timer_journal", 'short_timers.journal')
+# whether to LISTEN for timers inserted by other processes on a dedicated connection
+timer_listen = Config.get_conf_key('reminder', "listen", True, value_type='bool')
+# seconds a worker holds a claimed timer in lease mode before another worker may claim it again
+timer_lease_seconds = Config.get_conf_key('reminder', "lease_seconds", 300, value_type='int')
+##############################
+
 # #### Automation cog #########
 # number of days the inactive members will be announced in announcement channel
 num_announce_days = Config.get_conf_key('announcement', "num_announce_days", 2, value_type='int')
@@ -8,11 +8,12 @@ import traceback
 import importlib
 import asyncpg
 import sys
+import time
 
 import discord
 
 from utils.logger import DiscordHandler
-from utils.db import Table
+from utils.db import Table, QueryMonitor, SchemaError, MigrationPlan
 from config import BOT_TOKEN, SENTRY_URL, PostgreSQL
 from bot import Qutils, initial_extensions
 
@@ -92,7 +93,9 @@ def run_bot():
         bot.log = log
         """Entry point for poetry script."""
         try:
-            pool = loop.run_until_complete(Table.create_pool(postgres_config.return_connection_str(), command_timeout=60))
+            monitor = QueryMonitor(metrics=bot.metrics)
+            pool = loop.run_until_complete(Table.create_pool(postgres_config.return_connection_str(),
+                                                             command_timeout=60, monitor=monitor))
         except Exception as e:
             import traceback
             click.echo(f'Could not set up PostgreSQL. Exiting\n: {traceback.format_exc()}', file=sys.stderr)
@@ -104,11 +107,25 @@ def run_bot():
             bot.run()
 
 
+def print_startup_profile():
+    """Loads every extension one by one and prints how long each one took."""
+    start = time.perf_counter()
+    # a single import worker, so the imported packages are attributed to the right extension
+    bot = Qutils(discord.Intents.all(), defer_extensions=False, import_workers=1)
+    total = time.perf_counter() - start
+    click.echo(bot.startup_report())
+    click.echo(f'{"total":<20} {total:.3f}s')
+    bot.loop.run_until_complete(bot.session.close())
+
+
 @click.group(invoke_without_command=True, options_metavar='[options]')
+@click.option('--profile-startup', help='print the load time of every extension and exit', is_flag=True)
 @click.pass_context
-def main(ctx):
+def main(ctx, profile_startup):
     """Launches the bot."""
     if ctx.invoked_subcommand is None:
+        if profile_startup:
+            return print_startup_profile()
         run_bot()
 
 
@@ -120,15 +137,13 @@ def db():
 @db.command(short_help='initialises the databases for the bot', options_metavar='[options]')
 @click.argument('cogs', nargs=-1, metavar='[cogs]')
 @click.option('-q', '--quiet', help='less verbose output', is_flag=True)
-def init(cogs, quiet):
-    """This manages the migrations and database creation system for you."""
-    run = asyncio.get_event_loop().run_until_complete
-    try:
-        run(Table.create_pool(postgres_config.return_connection_str()))
-    except Exception:
-        click.echo(f'Could not create PostgreSQL connection pool.\n{traceback.format_exc()}', err=True)
-        return
+@click.option('--dry-run', help='only print the DDL of the tables', is_flag=True)
+def init(cogs, quiet, dry_run):
+    """This manages the migrations and database creation system for you.
 
+    Tables that do not reference each other are created concurrently,
+    each of them in its own transaction.
+    """
     if not cogs:
         cogs = initial_extensions
 
@@ -138,16 +153,36 @@ def init(cogs, quiet):
         click.echo(f'Extensions are not loaded.\n{traceback.format_exc()}', err=True)
         return
 
-    for table in Table.all_tables():
-        try:
-            created = run(table.create(verbose=not quiet, run_migrations=False))
-        except Exception:
-            click.echo(f'Could not create {table.__tablename__}.\n{traceback.format_exc()}', err=True)
+    tables = Table.all_tables()
+    try:
+        levels = Table.creation_order(tables)
+    except SchemaError as e:
+        click.echo(f'Could not order the tables: {e}', err=True)
+        return
+
+    if dry_run:
+        for index, level in enumerate(levels, 1):
+            click.echo(f'-- level {index}: {", ".join(table.__tablename__ for table in level)}')
+            for table in level:
+                click.echo(table.create_table(exists_ok=True))
+        return
+
+    run = asyncio.get_event_loop().run_until_complete
+    try:
+        run(Table.create_pool(postgres_config.return_connection_str()))
+    except Exception:
+        click.echo(f'Could not create PostgreSQL connection pool.\n{traceback.format_exc()}', err=True)
+        return
+
+    results = run(Table.create_all(tables, verbose=not quiet))
+    for table, result in results.items():
+        if isinstance(result, BaseException):
+            error = ''.join(traceback.format_exception(type(result), result, result.__traceback__))
+            click.echo(f'Could not create {table.__tablename__}.\n{error}', err=True)
+        elif result:
+            click.echo(f'[{table.__module__}] Table: {table.__tablename__} has been created.')
         else:
-            if created:
-                click.echo(f'[{table.__module__}] Table: {table.__tablename__} has been created.')
-            else:
-                click.echo(f'[{table.__module__}] No work needed for {table.__tablename__}.')
+            click.echo(f'[{table.__module__}] No work needed for {table.__tablename__}.')
 
 
 @db.command(short_help='migrates the databases')
@@ -184,9 +219,9 @@ def migrate(ctx, cog, quiet):
     click.echo(f'Done migrating {cog}.')
 
 
-async def apply_migration(cog, quiet, index, *, downgrade=False):
+async def apply_migration(cog, quiet, index, *, downgrade=False, lock_timeout='5s'):
     try:
-        pool = await Table.create_pool(postgres_config.return_connection_str())
+        await Table.create_pool(postgres_config.return_connection_str())
     except Exception:
         click.echo(f'Could not create PostgreSQL connection pool.\n{traceback.format_exc()}', err=True)
         return
@@ -196,38 +231,53 @@ async def apply_migration(cog, quiet, index, *, downgrade=False):
     except Exception:
         return
 
-    async with pool.acquire() as con:
-        tr = con.transaction()
-        await tr.start()
-        for table in Table.all_tables():
-            try:
-                await table.migrate(index=index, downgrade=downgrade, verbose=not quiet, connection=con)
-            except RuntimeError as e:
-                click.echo(f'Could not migrate {table.__tablename__}: {e}', err=True)
-                await tr.rollback()
-                break
-        else:
-            await tr.commit()
+    # every pending migration is computed first and then run in a single transaction
+    steps = []
+    for table in Table.all_tables():
+        try:
+            steps.append(table.migration_step(index=index, downgrade=downgrade))
+        except RuntimeError as e:
+            click.echo(f'Could not migrate {table.__tablename__}: {e}', err=True)
+            return
+
+    plan = MigrationPlan(steps, downgrade=downgrade)
+    if not plan:
+        click.echo('Found no migrations to run.')
+        return
+
+    for table_name, operation, reason in plan.rewrites():
+        click.echo(f'[{table_name}] {operation} {reason}, consider running it off-peak.')
+
+    try:
+        await plan.apply(lock_timeout=lock_timeout, verbose=not quiet)
+    except asyncpg.LockNotAvailableError:
+        click.echo(f'Could not acquire the table locks in {lock_timeout}, nothing has been migrated.', err=True)
+    except asyncpg.PostgresError as e:
+        click.echo(f'Could not migrate, nothing has been migrated: {e}', err=True)
+    else:
+        click.echo(f'Migrated {", ".join(step.table.__tablename__ for step in plan.steps)}.')
 
 
 @db.command(short_help='upgrades from a migration')
 @click.argument('cog', nargs=1, metavar='[cog]')
 @click.option('-q', '--quiet', help='less verbose output', is_flag=True)
 @click.option('--index', help='the index to use', default=-1)
-def upgrade(cog, quiet, index):
+@click.option('--lock-timeout', help='how long to wait for a table lock', default='5s')
+def upgrade(cog, quiet, index, lock_timeout):
     """Runs an upgrade from a migration"""
     run = asyncio.get_event_loop().run_until_complete
-    run(apply_migration(cog, quiet, index))
+    run(apply_migration(cog, quiet, index, lock_timeout=lock_timeout))
 
 
 @db.command(short_help='downgrades from a migration')
 @click.argument('cog', nargs=1, metavar='[cog]')
 @click.option('-q', '--quiet', help='less verbose output', is_flag=True)
 @click.option('--index', help='the index to use', default=-1)
-def downgrade(cog, quiet, index):
+@click.option('--lock-timeout', help='how long to wait for a table lock', default='5s')
+def downgrade(cog, quiet, index, lock_timeout):
     """Runs an downgrade from a migration"""
     run = asyncio.get_event_loop().run_until_complete
-    run(apply_migration(cog, quiet, index, downgrade=True))
+    run(apply_migration(cog, quiet, index, downgrade=True, lock_timeout=lock_timeout))
 
 
 async def remove_tables(pool, cog, quiet):
@@ -0,0 +1,38 @@
+class Blacklist:
+    """The globally blacklisted user and guild ids.
+
+    The ids are kept as integers in a set, so checking a message author or
+    a guild is a plain set lookup. Changes are persisted through the given
+    :class:`~utils.config.Config`, whose file maps the ids to ``True``.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._ids = {int(object_id) for object_id in store.all()}
+
+    def __contains__(self, object_id):
+        return object_id in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    async def add(self, object_id):
+        if object_id in self._ids:
+            return
+
+        self._ids.add(object_id)
+        await self.store.put(object_id, True)
+
+    async def remove(self, object_id):
+        """Removes an id, does nothing if it is not blacklisted."""
+        if object_id not in self._ids:
+            return
+
+        self._ids.discard(object_id)
+        await self.store.remove(object_id)
+
+    async def flush(self):
+        await self.store.flush()
@@ -0,0 +1,102 @@
+import time
+import asyncio
+from collections import OrderedDict
+
+
+class TTLCache:
+    """A read-through LRU cache whose entries expire after a time to live.
+
+    Misses are loaded with the given coroutine function, concurrent misses
+    of the same key wait for a single load. Failed loads are not cached.
+
+    Parameters
+    -----------
+    loader: Callable[[Any], Awaitable[Any]]
+        Loads the value of a key, e.g. from the database.
+    ttl: float
+        The default time to live of the entries in seconds.
+    max_size: int
+        The number of entries to keep, the least recently used ones are evicted.
+    """
+
+    def __init__(self, loader, *, ttl=300.0, max_size=1024):
+        self.loader = loader
+        self.ttl = ttl
+        self.max_size = max_size
+        # key -> (expires, value), the least recently used first
+        self._entries = OrderedDict()
+        # key -> the task loading it
+        self._loading = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self._lookup(key) is not self._entries
+
+    def _lookup(self, key):
+        # returns the entries themselves as a sentinel for a miss
+        try:
+            expires, value = self._entries[key]
+        except KeyError:
+            return self._entries
+
+        if expires <= time.monotonic():
+            del self._entries[key]
+            return self._entries
+
+        self._entries.move_to_end(key)
+        return value
+
+    def get_cached(self, key, default=None):
+        """Returns the cached value of a key without loading it."""
+        value = self._lookup(key)
+        return default if value is self._entries else value
+
+    async def get(self, key):
+        """Returns the value of a key, loading it on a miss."""
+        value = self._lookup(key)
+        if value is not self._entries:
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        task = self._loading.get(key)
+        if task is None:
+            task = self._loading[key] = asyncio.ensure_future(self._load(key))
+
+        # a cancelled waiter must not cancel the load the others wait for
+        return await asyncio.shield(task)
+
+    async def _load(self, key):
+        task = asyncio.current_task()
+        try:
+            value = await self.loader(key)
+        finally:
+            # the key might have been invalidated while loading, the value is stale then
+            current = self._loading.get(key) is task
+            if current:
+                del self._loading[key]
+
+        if current:
+            self.set(key, value)
+        return value
+
+    def set(self, key, value, *, ttl=None):
+        """Puts a value into the cache."""
+        self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """Drops a key, e.g. after its rows have been written."""
+        self._entries.pop(key, None)
+        self._loading.pop(key, None)
+
+    def clear(self):
+        """Drops every key."""
+        self._entries.clear()
+        self._loading.clear()
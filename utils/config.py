@@ -17,11 +17,22 @@ def _create_encoder(cls):
 
 
 class Config:
-    """The "database" object. Internally based on ``json``."""
+    """The "database" object. Internally based on ``json``.
+
+    With ``write_behind`` set to a delay in seconds, the changes are not
+    written one by one but coalesced into a single write once the delay
+    has passed since the first unsaved change. Call :meth:`flush` to
+    write them right away, e.g. before closing.
+    """
 
     def __init__(self, name, **options):
         self.name = name
         self._db = {}
+        self.write_behind = options.pop('write_behind', None)
+        # called with the key of every changed entry
+        self.on_change = options.pop('on_change', None)
+        self._dirty = False
+        self._flush_handle = None
         self.object_hook = options.pop('object_hook', None)
         self.encoder = options.pop('encoder', None)
 
@@ -51,17 +62,44 @@ class Config:
         async with self.lock:
             await self.loop.run_in_executor(None, self.load_from_file)
 
-    def _dump(self):
+    def _dump(self, data):
         temp = '%s-%s.tmp' % (uuid.uuid4(), self.name)
         with open(temp, 'w', encoding='utf-8') as tmp:
-            json.dump(self._db.copy(), tmp, ensure_ascii=True, cls=self.encoder, separators=(',', ':'))
+            json.dump(data, tmp, ensure_ascii=True, cls=self.encoder, separators=(',', ':'))
 
         # atomically move the file
         os.replace(temp, self.name)
 
     async def save(self):
         async with self.lock:
-            await self.loop.run_in_executor(None, self._dump)
+            # the snapshot is taken on the loop, the executor must not see the dict changing
+            self._dirty = False
+            await self.loop.run_in_executor(None, self._dump, self._db.copy())
+
+    async def _changed(self):
+        if self.write_behind is None:
+            return await self.save()
+
+        self._dirty = True
+        if self._flush_handle is None:
+            self._flush_handle = self.loop.call_later(self.write_behind, self._flush_later)
+
+    def _flush_later(self):
+        self._flush_handle = None
+        self.loop.create_task(self.flush())
+
+    async def flush(self):
+        """Writes the changes that are waiting for the write behind delay."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        if self._dirty:
+            try:
+                await self.save()
+            except Exception:
+                log.exception(f'Could not write {self.name}, retrying with the next change.')
+                self._dirty = True
 
     def get(self, key, *args):
         """Retrieves a config entry."""
@@ -70,12 +108,16 @@ class Config:
     async def put(self, key, value, *args):
         """Edits a config entry."""
         self._db[str(key)] = value
-        await self.save()
+        if self.on_change is not None:
+            self.on_change(str(key))
+        await self._changed()
 
     async def remove(self, key):
         """Removes a config entry."""
         del self._db[str(key)]
-        await self.save()
+        if self.on_change is not None:
+            self.on_change(str(key))
+        await self._changed()
 
     def __contains__(self, item):
         return str(item) in self._db
@@ -87,4 +129,95 @@ class Config:
         return len(self._db)
 
     def all(self):
-        return self._db
\ No newline at end of file
+        return self._db
+
+class JournalConfig(Config):
+    """A :class:`Config` that appends every change to a JSON lines journal.
+
+    The JSON file is kept as a snapshot, the journal next to it is replayed
+    on top of it when loading. A write only appends the changes since the
+    last one, once the journal grows over ``compact_size`` bytes it is
+    compacted into a new snapshot in the background.
+    """
+
+    def __init__(self, name, **options):
+        self.journal = options.pop('journal', f'{name}.journal')
+        self.compact_size = options.pop('compact_size', 64 * 1024)
+        self._journal_size = 0
+        self._lines = []
+        self._compacting = False
+        super().__init__(name, **options)
+
+    def load_from_file(self):
+        super().load_from_file()
+        try:
+            with open(self.journal, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        op, key, *value = json.loads(line, object_hook=self.object_hook)
+                    except ValueError:
+                        # a torn write at the end of the journal
+                        continue
+
+                    if op == 'put':
+                        self._db[key] = value[0]
+                    else:
+                        self._db.pop(key, None)
+
+            self._journal_size = os.path.getsize(self.journal)
+        except FileNotFoundError:
+            self._journal_size = 0
+
+    def _append(self, lines):
+        data = ''.join(lines)
+        with open(self.journal, 'a', encoding='utf-8') as f:
+            f.write(data)
+        return len(data)
+
+    async def save(self):
+        async with self.lock:
+            self._dirty = False
+            lines, self._lines = self._lines, []
+            if lines:
+                try:
+                    self._journal_size += await self.loop.run_in_executor(None, self._append, lines)
+                except Exception:
+                    # keep them for the next write
+                    self._lines[:0] = lines
+                    raise
+
+        if self._journal_size > self.compact_size and not self._compacting:
+            self._compacting = True
+            self.loop.create_task(self.compact())
+
+    def _compact(self, data):
+        self._dump(data)
+        # a crash before the truncation only replays changes the snapshot already has
+        with open(self.journal, 'w', encoding='utf-8'):
+            pass
+
+    async def compact(self):
+        """Writes the entries into a new snapshot and empties the journal."""
+        try:
+            async with self.lock:
+                # the buffered lines are part of the snapshot too
+                self._lines = []
+                self._dirty = False
+                await self.loop.run_in_executor(None, self._compact, self._db.copy())
+                self._journal_size = 0
+        except Exception:
+            log.exception(f'Could not compact the journal of {self.name}.')
+        finally:
+            self._compacting = False
+
+    def _record(self, *entry):
+        self._lines.append(json.dumps(entry, ensure_ascii=True, cls=self.encoder, separators=(',', ':')) + '\n')
+
+    async def put(self, key, value, *args):
+        self._record('put', str(key), value)
+        await super().put(key, value, *args)
+
+    async def remove(self, key):
+        if str(key) in self._db:
+            self._record('remove', str(key))
+        await super().remove(key)
@@ -16,6 +16,11 @@ import asyncpg
 import logging
 import asyncio
 import ssl
+import re
+import time
+import heapq
+import contextlib
+import contextvars
 
 log = logging.getLogger('root')
 
@@ -24,6 +29,10 @@ class SchemaError(Exception):
     pass
 
 
+class QueryError(Exception):
+    pass
+
+
 class SQLType:
     python = None
 
@@ -35,6 +44,7 @@ class SQLType:
 
     @classmethod
     def from_dict(cls, data):
+        data = dict(data)
         meta = data.pop('__meta__')
         given = cls.__module__ + '.' + cls.__qualname__
         if given != meta:
@@ -311,6 +321,7 @@ class Column:
 
     @classmethod
     def from_dict(cls, data):
+        data = dict(data)
         index_name = data.pop('index_name', None)
         column_type = data.pop('column_type')
         column_type = SQLType.from_dict(column_type)
@@ -366,6 +377,66 @@ class PrimaryKeyColumn(Column):
         super().__init__(Integer(auto_increment=True), primary_key=True)
 
 
+class Index:
+    """A table level index, for indexes that a single ``Column(index=True)`` cannot express.
+
+    Every element is either a column name or a parenthesised expression,
+    e.g. ``Index('event', "(extra #>> '{args,0}')", 'expires')``.
+
+    Parameters
+    -----------
+    \*columns: str
+        The column names and expressions to index, in order.
+    where: Optional[str]
+        The predicate of a partial index.
+    unique: bool
+        Whether to create a unique index.
+    name: Optional[str]
+        The index name, defaults to ``<table>_<attribute>_idx``.
+    """
+
+    __slots__ = ('columns', 'where', 'unique', 'name')
+
+    def __init__(self, *columns, where=None, unique=False, name=None):
+        if not columns:
+            raise SchemaError('Index must have at least one column or expression.')
+
+        self.columns = list(columns)
+        self.where = where
+        self.unique = unique
+        self.name = name
+
+    @classmethod
+    def from_dict(cls, data):
+        data = data.copy()
+        columns = data.pop('columns')
+        return cls(*columns, **data)
+
+    def to_dict(self):
+        return {attr: getattr(self, attr) for attr in self.__slots__}
+
+    def __eq__(self, other):
+        return isinstance(other, Index) and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def _create_index(self, table_name):
+        builder = ['CREATE']
+        if self.unique:
+            builder.append('UNIQUE')
+
+        builder.append('INDEX IF NOT EXISTS %s ON %s (%s)' % (self.name, table_name, ', '.join(self.columns)))
+        if self.where:
+            builder.append('WHERE %s' % self.where)
+
+        return ' '.join(builder) + ';'
+
+
+# defaults that are evaluated for every existing row when a column is added
+_VOLATILE_DEFAULT = re.compile(r'random|uuid|clock_timestamp|timeofday|nextval', re.IGNORECASE)
+
+
 class SchemaDiff:
     __slots__ = ('table', 'upgrade', 'downgrade')
 
@@ -434,11 +505,149 @@ class SchemaDiff:
             statements.append('DROP INDEX IF EXISTS {0[index]};'.format(dropped))
 
         for added in path.get('add_index', []):
+            # table level indexes carry their whole definition
+            if 'definition' in added:
+                statements.append(Index.from_dict(added['definition'])._create_index(self.table.__tablename__))
+                continue
+
             fmt = 'CREATE INDEX IF NOT EXISTS {0[index]} ON {1.__tablename__} ({0[name]});'
             statements.append(fmt.format(added, self.table))
 
         return '\n'.join(statements)
 
+    def rewrites(self, *, downgrade=False):
+        """Returns the operations that rewrite or scan the whole table while holding a lock on it.
+
+        These are best run off-peak.
+
+        Returns
+        --------
+        List[Tuple[str, str]]
+            The operation and what it does to the table.
+        """
+        path = self.upgrade if not downgrade else self.downgrade
+        rewrites = []
+
+        for changed_types in path.get('changed_column_types', []):
+            rewrites.append(('ALTER COLUMN {0[name]} SET DATA TYPE {0[type]}'.format(changed_types),
+                             'rewrites the table'))
+
+        for added in path.get('add_columns', []):
+            column = Column.from_dict(added)
+            column_type = column.column_type
+            # string defaults of text columns are quoted literals
+            expression = column.default is not None and not isinstance(column_type, String)
+            if getattr(column_type, 'auto_increment', False) or \
+                    (expression and _VOLATILE_DEFAULT.search(str(column.default))):
+                rewrites.append(('ADD COLUMN ' + column.name, 'rewrites the table to fill the volatile default'))
+            if column.primary_key or column.unique:
+                rewrites.append(('ADD COLUMN ' + column.name, 'builds an index and blocks writes meanwhile'))
+
+        for constraints in path.get('changed_constraints', []):
+            if constraints['before'].get('nullable') and not constraints['after'].get('nullable'):
+                rewrites.append(('ALTER COLUMN {0[name]} SET NOT NULL'.format(constraints), 'scans the table'))
+
+        for added in path.get('add_index', []):
+            rewrites.append(('CREATE INDEX ' + added['index'], 'builds an index and blocks writes meanwhile'))
+
+        return rewrites
+
+
+def _replace_json_files(files):
+    """Writes every file to a temporary file first, then moves them all into place."""
+    written = []
+    try:
+        for path, data in files.items():
+            temp_file = path.with_name('%s-%s.tmp' % (uuid.uuid4(), path.name))
+            written.append((temp_file, path))
+            with temp_file.open('w', encoding='utf-8') as tmp:
+                json.dump(data, tmp, indent=4, ensure_ascii=True)
+    except BaseException:
+        for temp_file, _ in written:
+            with contextlib.suppress(OSError):
+                temp_file.unlink()
+        raise
+
+    for temp_file, path in written:
+        temp_file.replace(path)
+
+
+class MigrationStep:
+    """A pending schema change of a table and the migration files to write once it is applied."""
+
+    __slots__ = ('table', 'diff', 'downgrade', 'files')
+
+    def __init__(self, table, diff, *, downgrade=False, files=None):
+        self.table = table
+        self.diff = diff
+        self.downgrade = downgrade
+        self.files = files or {}
+
+    def to_sql(self):
+        return self.diff.to_sql(downgrade=self.downgrade)
+
+    def rewrites(self):
+        return self.diff.rewrites(downgrade=self.downgrade)
+
+
+class MigrationPlan:
+    """Applies the pending migrations of many tables in a single transaction.
+
+    The steps are ordered so that referenced tables are upgraded first,
+    and downgraded last. The migration files are only written once the
+    transaction has been committed.
+    """
+
+    def __init__(self, steps, *, downgrade=False):
+        steps = [step for step in steps if step is not None and not step.diff.is_empty()]
+        order = {table: index for index, level in enumerate(Table.creation_order([step.table for step in steps]))
+                 for table in level}
+        self.steps = sorted(steps, key=lambda step: order[step.table], reverse=downgrade)
+
+    def __bool__(self):
+        return bool(self.steps)
+
+    def to_sql(self):
+        return '\n'.join(step.to_sql() for step in self.steps)
+
+    def rewrites(self):
+        """Returns the ``(table name, operation, reason)`` of the operations that lock a whole table for long."""
+        return [(step.table.__tablename__, operation, reason)
+                for step in self.steps for operation, reason in step.rewrites()]
+
+    async def apply(self, *, connection=None, lock_timeout='5s', verbose=False):
+        """Runs every step in a single transaction and then writes the migration files.
+
+        Parameters
+        -----------
+        connection: Optional[asyncpg.Connection]
+            The connection to use, if not provided will acquire one from
+            the internal pool.
+        lock_timeout: Optional[str]
+            How long a statement may wait for a lock, e.g. ``'5s'``, before
+            the whole migration is rolled back. ``None`` waits forever.
+        verbose: bool
+            Whether to output the SQL to stdout.
+        """
+        if not self.steps:
+            return
+
+        async with MaybeAcquire(connection, pool=Table._pool) as con:
+            async with con.transaction():
+                if lock_timeout is not None:
+                    await con.execute("SELECT set_config('lock_timeout', $1, true);", str(lock_timeout))
+
+                for step in self.steps:
+                    sql = step.to_sql()
+                    if verbose:
+                        print(sql)
+                    await con.execute(sql)
+
+        files = {}
+        for step in self.steps:
+            files.update(step.files)
+        _replace_json_files(files)
+
 
 class MaybeAcquire:
     def __init__(self, connection, *, pool):
@@ -458,6 +667,304 @@ class MaybeAcquire:
             await self.pool.release(self._connection)
 
 
+# the (cog, command) that runs the queries of the current task
+query_tags = contextvars.ContextVar('query_tags', default=None)
+
+
+class QueryMonitor:
+    """Collects the timings of the queries and of the pool acquisitions.
+
+    Parameters
+    -----------
+    top: int
+        The number of slowest statements to keep.
+    window: float
+        The slowest statements are kept for this many seconds.
+    metrics: Optional[utils.metrics.MetricsSink]
+        The sink to forward the measurements to.
+    """
+
+    def __init__(self, *, top=10, window=3600.0, metrics=None):
+        self.top = top
+        self.window = window
+        self.metrics = metrics
+        # min-heap of (elapsed, when, query, cog, command, rows)
+        self.slowest = []
+        self.queries = 0
+        self.failed = 0
+
+    def record_query(self, query, elapsed, rows, *, failed=False):
+        cog, command = query_tags.get() or ('-', '-')
+        self.queries += 1
+        self.failed += failed
+
+        now = time.time()
+        if self.slowest and self.slowest[0][1] < now - self.window:
+            self.slowest = [entry for entry in self.slowest if entry[1] >= now - self.window]
+            heapq.heapify(self.slowest)
+
+        entry = (elapsed, now, ' '.join(query.split()), cog, command, rows)
+        if len(self.slowest) < self.top:
+            heapq.heappush(self.slowest, entry)
+        elif elapsed > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+
+        if self.metrics is not None:
+            self.metrics.observe('db.query_seconds', elapsed, cog=cog, command=command)
+            self.metrics.increment('db.rows', rows, cog=cog, command=command)
+            if failed:
+                self.metrics.increment('db.failed_queries', cog=cog, command=command)
+
+    def record_acquire(self, elapsed, pool):
+        if self.metrics is not None:
+            self.metrics.observe('db.acquire_seconds', elapsed)
+            self.record_pool(pool)
+
+    def record_pool(self, pool):
+        if self.metrics is not None:
+            for name, value in pool.stats().items():
+                self.metrics.gauge(f'db.pool.{name}', value)
+
+    def slowest_statements(self):
+        """Returns the slowest statements of the window, the slowest first."""
+        return sorted(self.slowest, reverse=True)
+
+
+def _row_count(method, result, args):
+    if method == 'fetch':
+        return len(result)
+    if method in ('fetchrow', 'fetchval'):
+        return 0 if result is None else 1
+    if method == 'executemany':
+        return len(args[0]) if args else 0
+    # e.g. 'INSERT 0 5' or 'COPY 5'
+    count = result.rsplit(' ', 1)[-1] if isinstance(result, str) else ''
+    return int(count) if count.isdigit() else 0
+
+
+class InstrumentedConnection:
+    """Wraps a pooled connection and times the queries run through it."""
+
+    __slots__ = ('connection', 'monitor')
+
+    def __init__(self, connection, monitor):
+        self.connection = connection
+        self.monitor = monitor
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    async def _run(self, method, query, args, kwargs):
+        start = time.perf_counter()
+        failed = True
+        result = None
+        try:
+            result = await getattr(self.connection, method)(query, *args, **kwargs)
+            failed = False
+            return result
+        finally:
+            rows = 0 if failed else _row_count(method, result, args)
+            self.monitor.record_query(query, time.perf_counter() - start, rows, failed=failed)
+
+    async def execute(self, query, *args, **kwargs):
+        return await self._run('execute', query, args, kwargs)
+
+    async def executemany(self, command, args, **kwargs):
+        return await self._run('executemany', command, (args,), kwargs)
+
+    async def fetch(self, query, *args, **kwargs):
+        return await self._run('fetch', query, args, kwargs)
+
+    async def fetchrow(self, query, *args, **kwargs):
+        return await self._run('fetchrow', query, args, kwargs)
+
+    async def fetchval(self, query, *args, **kwargs):
+        return await self._run('fetchval', query, args, kwargs)
+
+
+class _InstrumentedAcquire:
+    __slots__ = ('pool', 'timeout', 'connection')
+
+    def __init__(self, pool, timeout):
+        self.pool = pool
+        self.timeout = timeout
+        self.connection = None
+
+    def __await__(self):
+        return self.pool._acquire(self.timeout).__await__()
+
+    async def __aenter__(self):
+        self.connection = await self.pool._acquire(self.timeout)
+        return self.connection
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.pool.release(self.connection)
+
+
+class InstrumentedPool:
+    """Wraps an asyncpg pool to time the acquisitions and the queries.
+
+    Every acquired connection is an :class:`InstrumentedConnection`, the
+    queries are tagged with the cog and the command in :data:`query_tags`.
+    Anything else is forwarded to the wrapped pool.
+    """
+
+    def __init__(self, pool, *, monitor=None):
+        self.pool = pool
+        self.monitor = monitor or QueryMonitor()
+        self.in_use = 0
+        self.waiting = 0
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+    def stats(self):
+        """Returns the size, idle count and saturation of the pool."""
+        try:
+            size = self.pool.get_size()
+        except AttributeError:
+            # older asyncpg versions do not expose the size
+            size = sum(1 for holder in self.pool._holders if holder._con is not None)
+        max_size = getattr(self.pool, '_maxsize', None) or size
+        return {'size': size, 'max_size': max_size, 'in_use': self.in_use,
+                'idle': max(size - self.in_use, 0), 'waiting': self.waiting}
+
+    async def _acquire(self, timeout):
+        start = time.perf_counter()
+        self.waiting += 1
+        try:
+            connection = await self.pool.acquire(timeout=timeout)
+        finally:
+            self.waiting -= 1
+
+        self.in_use += 1
+        self.monitor.record_acquire(time.perf_counter() - start, self)
+        return InstrumentedConnection(connection, self.monitor)
+
+    def acquire(self, *, timeout=None):
+        return _InstrumentedAcquire(self, timeout)
+
+    async def release(self, connection, *, timeout=None):
+        if isinstance(connection, InstrumentedConnection):
+            connection = connection.connection
+        self.in_use -= 1
+        try:
+            await self.pool.release(connection, timeout=timeout)
+        finally:
+            self.monitor.record_pool(self)
+
+    async def _run(self, method, *args, **kwargs):
+        async with self.acquire() as con:
+            return await getattr(con, method)(*args, **kwargs)
+
+    async def execute(self, query, *args, timeout=None):
+        return await self._run('execute', query, *args, timeout=timeout)
+
+    async def executemany(self, command, args, *, timeout=None):
+        return await self._run('executemany', command, args, timeout=timeout)
+
+    async def fetch(self, query, *args, timeout=None):
+        return await self._run('fetch', query, *args, timeout=timeout)
+
+    async def fetchrow(self, query, *args, timeout=None):
+        return await self._run('fetchrow', query, *args, timeout=timeout)
+
+    async def fetchval(self, query, *args, column=0, timeout=None):
+        return await self._run('fetchval', query, *args, column=column, timeout=timeout)
+
+
+class Query:
+    """A named, parameterized statement.
+
+    Every query is registered by its name when it is created and is
+    prepared on each pooled connection by the init hook of
+    :meth:`Table.create_pool`. Queries registered after a connection
+    has been set up, e.g. by an extension, are prepared on their first
+    use on that connection. asyncpg keeps the prepared statements in the
+    statement cache of the connection keyed by their text, so the text
+    of a query must never change: pass every value as a parameter.
+
+    Parameters
+    -----------
+    name: str
+        The unique name of the query.
+    sql: str
+        The statement, the values are passed as ``$1``, ``$2``, ...
+    """
+
+    registry = {}
+
+    # calls slower than this in seconds are logged
+    slow_threshold = 1.0
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = inspect.cleandoc(sql)
+        self.argc = max((int(index) for index in re.findall(r'\$(\d+)', self.sql)), default=0)
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+        old = self.registry.get(name)
+        if old is not None and old.sql != self.sql:
+            log.warning(f'Query {name} has been registered again with a different statement.')
+        self.registry[name] = self
+
+    def __repr__(self):
+        return f'<Query name={self.name!r} argc={self.argc} calls={self.calls}>'
+
+    @property
+    def mean_time(self):
+        return self.total_time / self.calls if self.calls else 0.0
+
+    async def prepare(self, connection):
+        """Prepares the statement into the statement cache of the given connection."""
+        # the public prepare() returns a statement bound to a single acquisition
+        # of a pooled connection, the cache outlives the acquisitions
+        await connection._get_statement(self.sql, None)
+
+    @classmethod
+    async def prepare_all(cls, connection):
+        for query in cls.registry.values():
+            try:
+                await query.prepare(connection)
+            except asyncpg.PostgresError as e:
+                # e.g. the table of the query does not exist yet
+                log.warning(f'Could not prepare query {query.name}: {e}')
+
+    async def _run(self, method, connection, args, timeout):
+        if len(args) != self.argc:
+            raise QueryError(f'Query {self.name} takes {self.argc} parameters but {len(args)} were given.')
+
+        start = time.perf_counter()
+        try:
+            return await getattr(connection, method)(self.sql, *args, timeout=timeout)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.calls += 1
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+            if elapsed > self.slow_threshold:
+                log.warning(f'Query {self.name} took {elapsed:.3f} seconds.')
+
+    async def fetch(self, connection, *args, timeout=None):
+        """Runs the query on a connection or a pool and returns all the rows."""
+        return await self._run('fetch', connection, args, timeout)
+
+    async def fetchrow(self, connection, *args, timeout=None):
+        """Runs the query on a connection or a pool and returns the first row."""
+        return await self._run('fetchrow', connection, args, timeout)
+
+    async def fetchval(self, connection, *args, column=0, timeout=None):
+        """Runs the query on a connection or a pool and returns a value of the first row."""
+        row = await self._run('fetchrow', connection, args, timeout)
+        return None if row is None else row[column]
+
+    async def execute(self, connection, *args, timeout=None):
+        """Runs the query on a connection or a pool and returns the status."""
+        return await self._run('execute', connection, args, timeout)
+
+
 class TableMeta(type):
     @classmethod
     def __prepare__(cls, name, bases, **kwargs):
@@ -465,6 +972,7 @@ class TableMeta(type):
 
     def __new__(cls, name, parents, dct, **kwargs):
         columns = []
+        indexes = []
 
         try:
             table_name = kwargs['table_name']
@@ -482,8 +990,16 @@ class TableMeta(type):
                     value.index_name = '%s_%s_idx' % (table_name, value.name)
 
                 columns.append(value)
+            elif isinstance(value, Index):
+                if value.name is None:
+                    value.name = '%s_%s_idx' % (table_name, elem)
+
+                indexes.append(value)
 
         dct['columns'] = columns
+        dct['indexes'] = indexes
+        # generated bulk statements keyed by their column set
+        dct['_bulk_sql'] = {}
         return super().__new__(cls, name, parents, dct)
 
     def __init__(self, name, parents, dct, **kwargs):
@@ -504,6 +1020,8 @@ class Table(metaclass=TableMeta):
         -----------
         uri: str
             The PostgreSQL URI to connect to.
+        monitor: Optional[QueryMonitor]
+            The monitor of the queries run through the pool.
         \*\*kwargs
             The arguments to forward to asyncpg.create_pool.
         """
@@ -519,11 +1037,13 @@ class Table(metaclass=TableMeta):
         async def init(con):
             await con.set_type_codec('jsonb', schema='pg_catalog', encoder=_encode_jsonb,
                                      decoder=_decode_jsonb, format='text')
+            await Query.prepare_all(con)
             if old_init is not None:
                 await old_init(con)
 
-        cls._pool = pool = await asyncpg.create_pool(uri, init=init, **kwargs)
-
+        monitor = kwargs.pop('monitor', None)
+        pool = await asyncpg.create_pool(uri, init=init, **kwargs)
+        cls._pool = pool = InstrumentedPool(pool, monitor=monitor)
 
         return pool
 
@@ -608,6 +1128,22 @@ class Table(metaclass=TableMeta):
             the internal pool.
         """
 
+        step = cls.migration_step(directory=directory, index=index, downgrade=downgrade)
+        if step is None:
+            return False
+
+        plan = MigrationPlan([step], downgrade=downgrade)
+        await plan.apply(connection=connection, verbose=verbose)
+
+    @classmethod
+    def migration_step(cls, *, directory='migrations', index=-1, downgrade=False):
+        """Returns the step of the migration pointed by the data file, or ``None`` if there is nothing to run.
+
+        Raises
+        -------
+        RuntimeError
+            The migration file of the table does not exist.
+        """
         directory = Path(directory) / cls.__tablename__
         p = directory.with_suffix('.json')
         if not p.exists():
@@ -620,21 +1156,14 @@ class Table(metaclass=TableMeta):
         try:
             migration = migrations[index]
         except IndexError:
-            return False
+            return None
 
         diff = SchemaDiff(cls, migration['upgrade'], migration['downgrade'])
         if diff.is_empty():
-            return False
-
-        async with MaybeAcquire(connection, pool=cls._pool) as con:
-            sql = diff.to_sql(downgrade=downgrade)
-            if verbose:
-                print(sql)
-            await con.execute(sql)
+            return None
 
         current = directory.with_name('current-' + p.name)
-        with current.open('w', encoding='utf-8') as fp:
-            json.dump(cls.to_dict(), fp, indent=4, ensure_ascii=True)
+        return MigrationStep(cls, diff, downgrade=downgrade, files={current: cls.to_dict()})
 
     @classmethod
     async def create(cls, *, directory='migrations', verbose=False, connection=None, run_migrations=True):
@@ -678,13 +1207,7 @@ class Table(metaclass=TableMeta):
                 await con.execute(sql)
 
             # since that step passed, let's go ahead and make the migration
-            with p.open('w', encoding='utf-8') as fp:
-                data = { 'table': table_data, 'migrations': [] }
-                json.dump(data, fp, indent=4, ensure_ascii=True)
-
-            with current.open('w', encoding='utf-8') as fp:
-                json.dump(table_data, fp, indent=4, ensure_ascii=True)
-
+            cls._write_initial_migration(p, current, table_data)
             return True
 
         if not run_migrations:
@@ -699,33 +1222,23 @@ class Table(metaclass=TableMeta):
         if diff.is_empty():
             return None
 
-        # execute the upgrade SQL
-        async with MaybeAcquire(connection, pool=cls._pool) as con:
-            sql = diff.to_sql()
-            if verbose:
-                print(sql)
-            await con.execute(sql)
-
         # load the migration data
         with p.open('r', encoding='utf-8') as fp:
             data = json.load(fp)
             migrations = data['migrations']
 
+        # update our "current" data in the filesystem once the upgrade SQL has been run
+        files = {current: table_data}
+
         # check if we should add it
         our_migrations = diff.to_dict()
         if len(migrations) == 0 or migrations[-1] != our_migrations:
             # we have a new migration, so add it
             migrations.append(our_migrations)
-            temp_file = p.with_name('%s-%s.tmp' % (uuid.uuid4(), p.name))
-            with temp_file.open('w', encoding='utf-8') as tmp:
-                json.dump(data, tmp, ensure_ascii=True, indent=4)
-
-            temp_file.replace(p)
-
-        # update our "current" data in the filesystem
-        with current.open('w', encoding='utf-8') as fp:
-            json.dump(table_data, fp, indent=4, ensure_ascii=True)
+            files[p] = data
 
+        plan = MigrationPlan([MigrationStep(cls, diff, files=files)])
+        await plan.apply(connection=connection, verbose=verbose)
         return False
 
     @classmethod
@@ -766,6 +1279,106 @@ class Table(metaclass=TableMeta):
                 print(sql)
             await con.execute(sql)
 
+    @staticmethod
+    def _write_initial_migration(path, current, table_data):
+        with path.open('w', encoding='utf-8') as fp:
+            data = { 'table': table_data, 'migrations': [] }
+            json.dump(data, fp, indent=4, ensure_ascii=True)
+
+        with current.open('w', encoding='utf-8') as fp:
+            json.dump(table_data, fp, indent=4, ensure_ascii=True)
+
+    @classmethod
+    def referenced_tables(cls):
+        """Returns the names of the other tables this table has foreign keys to."""
+        # the generated statement is parsed too, since tables might add constraints to it
+        names = {column.column_type.table for column in cls.columns if isinstance(column.column_type, ForeignKey)}
+        names.update(re.findall(r'\bREFERENCES\s+"?(\w+)"?', cls.create_table(exists_ok=True), re.IGNORECASE))
+        names.discard(cls.__tablename__)
+        return names
+
+    @classmethod
+    def creation_order(cls, tables):
+        """Groups the tables into levels, every table only references tables of the earlier levels.
+
+        References to tables that are not given are assumed to exist already.
+
+        Raises
+        -------
+        SchemaError
+            The tables reference each other in a cycle.
+        """
+        by_name = {table.__tablename__: table for table in tables}
+        pending = {name: table.referenced_tables() & by_name.keys() for name, table in by_name.items()}
+
+        levels = []
+        while pending:
+            level = sorted(name for name, references in pending.items() if not references)
+            if not level:
+                raise SchemaError('Tables reference each other in a cycle: %s' % ', '.join(sorted(pending)))
+
+            for name in level:
+                del pending[name]
+            for references in pending.values():
+                references.difference_update(level)
+
+            levels.append([by_name[name] for name in level])
+
+        return levels
+
+    @classmethod
+    async def _create_independently(cls, directory, verbose):
+        sql = cls.create_table(exists_ok=True)
+        if verbose:
+            print(sql)
+
+        async with cls._pool.acquire() as con:
+            async with con.transaction():
+                await con.execute(sql)
+
+        directory = Path(directory) / cls.__tablename__
+        p = directory.with_suffix('.json')
+        if p.exists():
+            return False
+
+        p.parent.mkdir(parents=True, exist_ok=True)
+        cls._write_initial_migration(p, directory.with_name('current-' + p.name), cls.to_dict())
+        return True
+
+    @classmethod
+    async def create_all(cls, tables, *, directory='migrations', verbose=False):
+        """Creates the given tables concurrently over the pool, each in its own transaction.
+
+        A table is created once every table it references has been, the
+        tables whose references failed are skipped. Migrations are not run.
+
+        Returns
+        --------
+        Dict[Type[Table], Union[bool, BaseException]]
+            ``True`` if the migration file of the table was created,
+            ``False`` if it already existed, or the error the creation failed with.
+        """
+        results = {}
+        failed = set()
+        for level in cls.creation_order(tables):
+            to_create = []
+            for table in level:
+                missing = table.referenced_tables() & failed
+                if missing:
+                    failed.add(table.__tablename__)
+                    results[table] = SchemaError('Referenced tables were not created: %s' % ', '.join(sorted(missing)))
+                else:
+                    to_create.append(table)
+
+            created = await asyncio.gather(*(table._create_independently(directory, verbose) for table in to_create),
+                                           return_exceptions=True)
+            for table, result in zip(to_create, created):
+                if isinstance(result, BaseException):
+                    failed.add(table.__tablename__)
+                results[table] = result
+
+        return results
+
     @classmethod
     def create_table(cls, *, exists_ok=True):
         """Generates the CREATE TABLE stub."""
@@ -793,6 +1406,9 @@ class Table(metaclass=TableMeta):
                 fmt = 'CREATE INDEX IF NOT EXISTS {1.index_name} ON {0} ({1.name});'.format(cls.__tablename__, column)
                 statements.append(fmt)
 
+        for index in cls.indexes:
+            statements.append(index._create_index(cls.__tablename__))
+
         return '\n'.join(statements)
 
     @classmethod
@@ -836,10 +1452,207 @@ class Table(metaclass=TableMeta):
         async with MaybeAcquire(connection, pool=cls._pool) as con:
             await con.execute(sql, *verified.values())
 
+    @classmethod
+    def _verify_rows(cls, rows):
+        """Checks a batch of rows, returns the column names and the rows as tuples.
+
+        Every row must be a mapping with the same keys.
+        """
+        if not rows:
+            return (), []
+
+        names = tuple(rows[0])
+        lookup = {column.name: column for column in cls.columns}
+        checks = []
+        for name in names:
+            try:
+                column = lookup[name]
+            except KeyError:
+                raise TypeError('Table %s has no column %s.' % (cls.__tablename__, name)) from None
+            checks.append((column, column.column_type.python))
+
+        records = []
+        for row in rows:
+            if len(row) != len(names):
+                raise TypeError('Every row of a batch must have the columns %s.' % ', '.join(names))
+
+            try:
+                record = tuple(row[name] for name in names)
+            except KeyError as e:
+                raise TypeError('Every row of a batch must have the columns %s, missing %s.'
+                                % (', '.join(names), e.args[0])) from None
+
+            for (column, check), value in zip(checks, record):
+                if value is None:
+                    if not column.nullable:
+                        raise TypeError('Cannot pass None to non-nullable column %s.' % column.name)
+                elif check and not isinstance(value, check):
+                    fmt = 'column {0.name} expected {1.__name__}, received {2.__class__.__name__}'
+                    raise TypeError(fmt.format(column, check, value))
+
+            records.append(record)
+
+        return names, records
+
+    @classmethod
+    def _array_type(cls, name):
+        column_type = next(column.column_type for column in cls.columns if column.name == name)
+        if isinstance(column_type, ForeignKey):
+            return column_type.sql_type + '[]'
+        if isinstance(column_type, Integer) and column_type.auto_increment:
+            return 'BIGINT[]' if column_type.big else 'SMALLINT[]' if column_type.small else 'INTEGER[]'
+        if isinstance(column_type, Array):
+            # unnest flattens nested arrays
+            return None
+        return column_type.to_sql() + '[]'
+
+    @classmethod
+    def _bulk_statement(cls, names, *, conflict=None, update=None, returning=None, unnest=False):
+        key = (names, conflict, update, returning, unnest)
+        try:
+            return cls._bulk_sql[key]
+        except KeyError:
+            pass
+
+        columns = ', '.join(names)
+        if unnest:
+            types = [cls._array_type(name) for name in names]
+            if None in types:
+                sql = None
+            else:
+                arrays = ', '.join('$%s::%s' % (i, sql_type) for i, sql_type in enumerate(types, 1))
+                sql = 'INSERT INTO {0} ({1}) SELECT * FROM unnest({2})'.format(cls.__tablename__, columns, arrays)
+        else:
+            values = ', '.join('$' + str(i) for i, _ in enumerate(names, 1))
+            sql = 'INSERT INTO {0} ({1}) VALUES ({2})'.format(cls.__tablename__, columns, values)
+
+        if sql is not None:
+            if conflict is not None:
+                sql += ' ON CONFLICT (%s)' % ', '.join(conflict)
+                if update:
+                    sql += ' DO UPDATE SET ' + ', '.join('%s = %s' % pair for pair in update)
+                else:
+                    sql += ' DO NOTHING'
+
+            if returning:
+                sql += ' RETURNING ' + ', '.join(returning)
+            sql += ';'
+
+        cls._bulk_sql[key] = sql
+        return sql
+
+    @classmethod
+    async def _insert_batch(cls, rows, connection, *, conflict=None, update=None, returning=None):
+        names, records = cls._verify_rows(rows)
+        if not records:
+            return [] if returning else 0
+
+        if returning is None:
+            sql = cls._bulk_statement(names, conflict=conflict, update=update)
+            async with MaybeAcquire(connection, pool=cls._pool) as con:
+                await con.executemany(sql, records)
+            return len(records)
+
+        sql = cls._bulk_statement(names, conflict=conflict, update=update, returning=returning, unnest=True)
+        async with MaybeAcquire(connection, pool=cls._pool) as con:
+            if sql is not None:
+                return await con.fetch(sql, *(list(values) for values in zip(*records)))
+
+            # array columns cannot be unnested, so fall back to a statement per row
+            sql = cls._bulk_statement(names, conflict=conflict, update=update, returning=returning)
+            result = []
+            async with con.transaction():
+                for record in records:
+                    result.extend(await con.fetch(sql, *record))
+            return result
+
+    @classmethod
+    async def insert_many(cls, rows, *, connection=None, returning=None, copy_threshold=1000):
+        """Inserts many rows to the table.
+
+        Parameters
+        -----------
+        rows: List[Mapping[str, Any]]
+            The rows to insert, each of them must have the same columns.
+        connection
+            The connection to use, a pooled one is acquired if not given.
+        returning: Optional[Iterable[str]]
+            The columns to return of the inserted rows.
+        copy_threshold: Optional[int]
+            Batches of at least this many rows are loaded with COPY unless
+            ``returning`` is given. ``None`` disables it.
+
+        Returns
+        --------
+        Union[int, List[asyncpg.Record]]
+            The number of inserted rows, or the returned rows if ``returning`` is given.
+        """
+        returning = tuple(returning) if returning else None
+        if returning is None and copy_threshold is not None and len(rows) >= copy_threshold:
+            return await cls.copy_in(rows, connection=connection)
+
+        return await cls._insert_batch(rows, connection, returning=returning)
+
+    @classmethod
+    async def upsert_many(cls, rows, *, conflict=None, update=None, connection=None, returning=None):
+        """Inserts many rows to the table, updating the rows that already exist.
+
+        Parameters
+        -----------
+        rows: List[Mapping[str, Any]]
+            The rows to upsert, each of them must have the same columns.
+        conflict: Optional[Iterable[str]]
+            The columns of the unique constraint to check, the primary key by default.
+        update: Union[Iterable[str], Mapping[str, str], None]
+            The columns to update on a conflict, every non conflicting column
+            of the rows by default. A mapping gives the SQL expression of each
+            column, where ``EXCLUDED`` is the proposed row. An empty one
+            ignores the conflicting rows.
+        connection
+            The connection to use, a pooled one is acquired if not given.
+        returning: Optional[Iterable[str]]
+            The columns to return of the inserted or updated rows. A batch
+            returning rows cannot touch the same row twice.
+
+        Returns
+        --------
+        Union[int, List[asyncpg.Record]]
+            The number of given rows, or the returned rows if ``returning`` is given.
+        """
+        if not rows:
+            return [] if returning else 0
+
+        if conflict is None:
+            conflict = [column.name for column in cls.columns if column.primary_key]
+        conflict = tuple(conflict)
+
+        if update is None:
+            update = [name for name in rows[0] if name not in conflict]
+
+        if isinstance(update, dict):
+            update = tuple(update.items())
+        else:
+            update = tuple((name, 'EXCLUDED.' + name) for name in update)
+
+        returning = tuple(returning) if returning else None
+        return await cls._insert_batch(rows, connection, conflict=conflict, update=update, returning=returning)
+
+    @classmethod
+    async def copy_in(cls, rows, *, connection=None):
+        """Loads many rows to the table with COPY and returns the number of rows copied."""
+        names, records = cls._verify_rows(rows)
+        if not records:
+            return 0
+
+        async with MaybeAcquire(connection, pool=cls._pool) as con:
+            status = await con.copy_records_to_table(cls.__tablename__, records=records, columns=names)
+        return int(status.split()[-1])
+
     @classmethod
     def to_dict(cls):
         x = {'name': cls.__tablename__, '__meta__': cls.__module__ + '.' + cls.__qualname__,
-             'columns': [a._to_dict() for a in cls.columns]}
+             'columns': [a._to_dict() for a in cls.columns],
+             'indexes': [a.to_dict() for a in cls.indexes]}
 
         # nb: columns is ordered due to the ordered dict usage
         #     this is used to help detect renames
@@ -857,6 +1670,8 @@ class Table(metaclass=TableMeta):
         self = cls()
         self.__tablename__ = data['name']
         self.columns = [Column.from_dict(a) for a in data['columns']]
+        # older data files predate table level indexes
+        self.indexes = [Index.from_dict(a) for a in data.get('indexes', [])]
         return self
 
     @classmethod
@@ -893,6 +1708,7 @@ class Table(metaclass=TableMeta):
         add_index:
             name: str [The column name]
             index: str [The index name]
+            definition: Optional[object] [The table level index, replaces name]
         changed_constraints:
             name: str [The column name]
             before:
@@ -1012,6 +1828,26 @@ class Table(metaclass=TableMeta):
             upgrade.setdefault('remove_columns', []).extend(removed)
             downgrade.setdefault('add_columns', []).extend(removed)
 
+        # table level indexes are matched by name, a changed definition is dropped and re-created
+        before_indexes = {index.name: index for index in before.indexes}
+        after_indexes = {index.name: index for index in self.indexes}
+        for name, index in after_indexes.items():
+            previous = before_indexes.get(name)
+            if previous == index:
+                continue
+
+            if previous is not None:
+                upgrade.setdefault('drop_index', []).append({ 'index': name })
+                downgrade.setdefault('add_index', []).append({ 'index': name, 'definition': previous.to_dict() })
+
+            upgrade.setdefault('add_index', []).append({ 'index': name, 'definition': index.to_dict() })
+            downgrade.setdefault('drop_index', []).append({ 'index': name })
+
+        for name, index in before_indexes.items():
+            if name not in after_indexes:
+                upgrade.setdefault('drop_index', []).append({ 'index': name })
+                downgrade.setdefault('add_index', []).append({ 'index': name, 'definition': index.to_dict() })
+
         return SchemaDiff(self, upgrade, downgrade)
 
 
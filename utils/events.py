@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import random
+import struct
+from array import array
+from collections import deque
+
+# RECONNECT and INVALID_SESSION, their payloads are always kept
+ERROR_OPS = frozenset((7, 9))
+
+_MAGIC = b'QEV1'
+_LENGTH = struct.Struct('<I')
+# timestamp, sequence, op, size, event name index
+_RECORD = struct.Struct('<dqbIH')
+
+
+class EventRecorder:
+    """Records a compact summary of the latest gateway frames.
+
+    The summaries live in preallocated arrays used as a ring buffer, so
+    recording a frame neither allocates nor keeps the decoded payload.
+    Full payloads are only kept for a random sample of the frames and for
+    the error frames, in a separate bounded queue.
+
+    Parameters
+    -----------
+    size: int
+        The number of frames to keep.
+    sample_rate: float
+        The share of the frames whose payload is kept, between 0 and 1.
+    payloads: int
+        The number of payloads to keep.
+    """
+
+    def __init__(self, size=1024, *, sample_rate=0.0, payloads=16):
+        self.size = size
+        self.sample_rate = sample_rate
+        self._timestamps = array('d', bytes(8 * size))
+        self._sequences = array('q', bytes(8 * size))
+        self._ops = array('b', bytes(size))
+        self._sizes = array('I', bytes(4 * size))
+        self._names = array('H', bytes(2 * size))
+        # event name -> index, 0 is kept for the frames without a name
+        self._name_index = {None: 0}
+        self.payloads = deque(maxlen=payloads)
+        self.count = 0
+        # bytes received since the last decoded frame, zlib-stream frames can span several messages
+        self._pending_bytes = 0
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def received(self, size):
+        """Adds the size of a raw gateway message."""
+        self._pending_bytes += size
+
+    def record(self, msg):
+        """Records a decoded gateway frame."""
+        index = self.count % self.size
+        self.count += 1
+
+        op = msg.get('op')
+        name = msg.get('t')
+        try:
+            name_index = self._name_index[name]
+        except KeyError:
+            name_index = self._name_index[name] = len(self._name_index)
+
+        self._timestamps[index] = time.time()
+        self._sequences[index] = msg.get('s') or -1
+        self._ops[index] = op if op is not None else -1
+        self._sizes[index] = min(self._pending_bytes, 0xFFFFFFFF)
+        self._names[index] = name_index
+        self._pending_bytes = 0
+
+        if op in ERROR_OPS or (self.sample_rate and random.random() < self.sample_rate):
+            self.payloads.append(msg)
+
+    def summaries(self):
+        """Returns the ``(timestamp, sequence, op, size, event name)`` summaries, the oldest first."""
+        names = {index: name for name, index in self._name_index.items()}
+        start = self.count - len(self)
+        result = []
+        for position in range(start, self.count):
+            index = position % self.size
+            sequence = self._sequences[index]
+            result.append((self._timestamps[index], None if sequence < 0 else sequence, self._ops[index],
+                           self._sizes[index], names[self._names[index]]))
+        return result
+
+    def dump(self, name, *, backups=5):
+        """Writes the summaries and the kept payloads to a binary file.
+
+        The previous dumps are rotated to ``name.1``, ``name.2``, ... and
+        only ``backups`` of them are kept.
+        """
+        for number in range(backups, 0, -1):
+            source = f'{name}.{number - 1}' if number > 1 else name
+            if os.path.exists(source):
+                os.replace(source, f'{name}.{number}')
+
+        names = json.dumps([name for name, _ in sorted(self._name_index.items(), key=lambda item: item[1])])
+        payloads = json.dumps(list(self.payloads), ensure_ascii=True, default=str)
+        with open(name, 'wb') as fp:
+            fp.write(_MAGIC)
+            blob = names.encode('utf-8')
+            fp.write(_LENGTH.pack(len(blob)))
+            fp.write(blob)
+
+            fp.write(_LENGTH.pack(len(self)))
+            for timestamp, sequence, op, size, event in self.summaries():
+                fp.write(_RECORD.pack(timestamp, -1 if sequence is None else sequence, op, size,
+                                      self._name_index[event]))
+
+            blob = payloads.encode('utf-8')
+            fp.write(_LENGTH.pack(len(blob)))
+            fp.write(blob)
+
+
+def read_dump(name):
+    """Reads a file written by :meth:`EventRecorder.dump`, returns the summaries and the payloads."""
+    with open(name, 'rb') as fp:
+        if fp.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError(f'{name} is not an event dump.')
+
+        length, = _LENGTH.unpack(fp.read(_LENGTH.size))
+        names = json.loads(fp.read(length).decode('utf-8'))
+
+        count, = _LENGTH.unpack(fp.read(_LENGTH.size))
+        summaries = []
+        for _ in range(count):
+            timestamp, sequence, op, size, name_index = _RECORD.unpack(fp.read(_RECORD.size))
+            summaries.append((timestamp, None if sequence < 0 else sequence, op, size, names[name_index]))
+
+        length, = _LENGTH.unpack(fp.read(_LENGTH.size))
+        payloads = json.loads(fp.read(length).decode('utf-8'))
+
+    return summaries, payloads
@@ -1,6 +1,10 @@
-from io import StringIO, BytesIO
+from io import StringIO, BytesIO, TextIOWrapper
 import csv
+import gzip
+import shutil
 import random
+import asyncio
+import tempfile
 
 from libneko import pag, Embed as libEmbed, unspecified_field, empty_field
 from discord import Embed, Colour, utils
@@ -66,55 +70,119 @@ def human_join(seq, delim=', ', final='or'):
 
 
 class TabularData:
+    """A table stored column by column.
+
+    Every cell is converted to a string once, when its row is added, and
+    kept a single time for both the rendered table and the CSV file.
+    The column widths are computed in one pass over each column when the
+    table is rendered, so rows can keep arriving between two renders.
+    """
+
     def __init__(self, line_break='\n'):
-        self._widths = []
         self._columns = []
-        self._table_rows = []
-        self._csv_rows = []
+        # the minimum width of every displayed column
+        self._min_widths = []
+        # one list of cells for every element of the rows
+        self._cells = []
+        # the row elements left out of the rendered table
+        self._hidden = frozenset()
+        self._row_count = 0
+        self._widths_cache = None
         self._line_break = line_break
 
+    def __len__(self):
+        return self._row_count
+
     def set_columns(self, columns):
         self._columns = columns
-        self._widths = [len(c) + 2 for c in columns]
+        self._min_widths = [len(c) + 2 for c in columns]
+        self._widths_cache = None
 
     def add_row(self, row, exception_index=None):
-        # row element list_role for original and filtered table row
-        valid_index = 0
-        elements, table_elements = [], []
-        for index, element in enumerate(row):
-            element = str(element)
-            elements.append(element)
-            if exception_index and index not in exception_index:
-                width = len(element) + 2
-                if width > self._widths[valid_index]:
-                    self._widths[valid_index] = width
+        # the elements in exception_index are only written to the CSV file
+        self.add_rows((row,), exception_index)
 
-                valid_index += 1
+    def add_rows(self, rows, exception_index=None):
+        self._hidden = frozenset(exception_index or ())
+        cells = self._cells
+        for row in rows:
+            if not cells:
+                cells.extend([] for _ in row)
+            for column, element in zip(cells, row):
+                column.append(str(element))
+            self._row_count += 1
+
+        self._widths_cache = None
 
-                table_elements.append(element)
+    @property
+    def _table_columns(self):
+        return [column for index, column in enumerate(self._cells) if index not in self._hidden]
 
-        self._table_rows.append(table_elements)
-        self._csv_rows.append(elements)
+    @property
+    def _widths(self):
+        if self._widths_cache is None:
+            widths = list(self._min_widths)
+            for index, column in enumerate(self._table_columns):
+                width = max(map(len, column), default=0) + 2
+                if index < len(widths):
+                    widths[index] = max(widths[index], width)
+            self._widths_cache = widths
+        return self._widths_cache
 
     def to_csv(self, column_list):
         in_memory_file = StringIO()
         csv_writer = csv.writer(in_memory_file)
-        csv_writer.writerows([column_list, *self._csv_rows])
+        csv_writer.writerow(column_list)
+        csv_writer.writerows(zip(*self._cells))
         in_memory_file.seek(0)
 
         return in_memory_file
 
+    @staticmethod
+    async def stream_csv(column_list, rows, filename, *, spool_size=1024 * 1024, compress_size=4 * 1024 * 1024):
+        """Writes the rows of an async iterator as CSV without keeping them in memory.
+
+        The file stays in memory until it grows over ``spool_size`` bytes,
+        then it is moved to a temporary file. Files over ``compress_size``
+        bytes are gzip compressed and ``.gz`` is appended to their name.
+
+        Returns the file, positioned at the start, and its name.
+        """
+        spooled = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        text = TextIOWrapper(spooled, encoding='utf-8', newline='')
+        try:
+            csv_writer = csv.writer(text)
+            csv_writer.writerow(column_list)
+            async for row in rows:
+                csv_writer.writerow(row)
+            text.flush()
+        except BaseException:
+            text.close()
+            raise
+        text.detach()
+
+        if spooled.tell() <= compress_size:
+            spooled.seek(0)
+            return spooled, filename
+
+        def compress():
+            compressed = tempfile.SpooledTemporaryFile(max_size=spool_size)
+            with spooled, gzip.GzipFile(filename=filename, mode='wb', fileobj=compressed) as gz:
+                spooled.seek(0)
+                shutil.copyfileobj(spooled, gz)
+            compressed.seek(0)
+            return compressed
+
+        return await asyncio.get_event_loop().run_in_executor(None, compress), f'{filename}.gz'
+
     def set_col_width(self, col_name, width):
         try:
             col_index = self._columns.index(col_name)
         except ValueError:
             return
         else:
-            self._widths[col_index] = width + 2
-
-    def add_rows(self, rows, exception_index=None):
-        for row in rows:
-            self.add_row(row, exception_index)
+            self._min_widths[col_index] = width + 2
+            self._widths_cache = None
 
     def get_entry(self, d, empty_char='\u2005'):
         elem = '|'.join(f'{e:{empty_char}^{self._widths[i]}}' for i, e in enumerate(d))
@@ -127,6 +195,19 @@ class TabularData:
 
         return self._line_break.join([sep, col_str, sep])
 
+    def _render_lines(self, start, stop, empty_char):
+        # pads a whole column at once, the extra space goes to the right like the ^ format spec
+        padded = []
+        for column, width in zip(self._table_columns, self._widths):
+            cells = []
+            for cell in column[start:stop]:
+                space = width - len(cell)
+                left = space // 2
+                cells.append(empty_char * left + cell + empty_char * (space - left))
+            padded.append(cells)
+
+        return ['|' + '|'.join(cells) + '|' for cells in zip(*padded)]
+
     def render(self, render_column=True, empty_char=' '):
         """Renders a table in rST format.
 
@@ -143,16 +224,40 @@ class TabularData:
         sep = '+'.join('-' * w for w in self._widths)
         sep = f'+{sep}+'
 
-        to_draw = []
-        col_str = ''
+        to_draw = self._render_lines(0, self._row_count, empty_char)
         if render_column:
-            col_str = self.get_column_str()
-
-        for row in self._table_rows:
-            to_draw.append(self.get_entry(row, empty_char))
+            to_draw.insert(0, self.get_column_str())
 
         to_draw.append(sep)
-        return col_str + self._line_break.join(to_draw)
+        return self._line_break.join(to_draw)
+
+    def rows_per_page(self, max_chars=2000, *, render_column=True):
+        """Returns the number of rows of a page of :meth:`render_pages`.
+
+        It only holds while no added row widens a column, set the widths up
+        front with :meth:`set_col_width` to size pages before the rows arrive.
+        """
+        header = len(self.get_column_str()) + len(self._line_break) if render_column else 0
+        # every row line and the closing separator are as long as a separator
+        line_length = sum(self._widths) + len(self._widths) + 1 + len(self._line_break)
+        return max(1, (max_chars - header - line_length) // line_length)
+
+    def render_pages(self, max_chars=2000, *, start=0, render_column=True, empty_char=' '):
+        """Renders the rows from ``start`` on as pages of at most ``max_chars`` characters.
+
+        Every row line has the same length, so the number of rows per page is
+        known up front and each page is rendered on its own. Pass the number of
+        rows rendered so far as ``start`` to continue once more rows have arrived.
+        """
+        sep = '+'.join('-' * w for w in self._widths)
+        sep = f'+{sep}+'
+        header = self.get_column_str() + self._line_break if render_column else ''
+        per_page = self.rows_per_page(max_chars, render_column=render_column)
+
+        for page_start in range(start, self._row_count, per_page):
+            lines = self._render_lines(page_start, page_start + per_page, empty_char)
+            lines.append(sep)
+            yield header + self._line_break.join(lines)
 
 
 class CustomEmbed(libEmbed):
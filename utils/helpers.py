@@ -167,6 +167,23 @@ async def get_multichoice_answer(client, ctx, choices: dict, question: str, time
     return None if choice_int < 0 else choices[choice_int], (choice, question_msg)
 
 
+async def get_row_number_answer(client, ctx, row_count: int, question: str, timeout: int = 120):
+    """ Send a question asking for a row number between 1 and row_count, return the number or None if cancelled"""
+    def check_msg(m):
+        if m.author.id != ctx.author.id:
+            return False
+        if m.channel != ctx.channel:
+            return False
+
+        return m.content == 'c' or (1 <= representsInt(m.content) <= row_count)
+
+    question_msg = await ctx.channel.send(question)
+    choice = await client.wait_for("message", check=check_msg, timeout=timeout)
+
+    choice_int = representsInt(choice.content)
+    return None if choice_int < 0 else choice_int, (choice, question_msg)
+
+
 async def cleanup_messages(channel: TextChannel, messages: Iterable[abc.Snowflake],
                            navigators: Optional[Iterable[pag.BaseNavigator]] = None, delete_after: int = 5):
     """ Bulk delete messages in the given iterator """
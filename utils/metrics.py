@@ -0,0 +1,120 @@
+import bisect
+import collections
+
+# upper bounds in seconds, the last bucket catches everything above
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+
+class Histogram:
+    """A fixed bucket histogram."""
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum', 'min', 'max')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, q):
+        """Returns the upper bound of the bucket the given quantile falls in."""
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else self.max
+        return self.max
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'buckets': dict(zip(self.buckets + ('inf',), self.counts))}
+
+
+class MetricsSink:
+    """Receives the metrics of the bot. This one drops everything.
+
+    Subclass it and assign an instance to ``bot.metrics`` to send the
+    metrics somewhere else.
+    """
+
+    def observe(self, name, value, **tags):
+        """Records a value into the histogram of the given name."""
+        pass
+
+    def gauge(self, name, value, **tags):
+        """Sets the current value of a gauge."""
+        pass
+
+    def increment(self, name, value=1, **tags):
+        """Increments a counter."""
+        pass
+
+
+class InMemorySink(MetricsSink):
+    """Keeps every metric in memory, keyed by the metric name and its tags."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}
+        self.gauges = {}
+        self.counters = collections.Counter()
+
+    @staticmethod
+    def _key(name, tags):
+        return name, tuple(sorted(tags.items()))
+
+    def observe(self, name, value, **tags):
+        key = self._key(name, tags)
+        try:
+            histogram = self.histograms[key]
+        except KeyError:
+            histogram = self.histograms[key] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    def gauge(self, name, value, **tags):
+        self.gauges[self._key(name, tags)] = value
+
+    def increment(self, name, value=1, **tags):
+        self.counters[self._key(name, tags)] += value
+
+    def format(self, prefix=''):
+        """Renders the metrics starting with the given prefix, one per line."""
+        def label(key):
+            name, tags = key
+            if not tags:
+                return name
+            return '%s{%s}' % (name, ','.join(f'{k}={v}' for k, v in tags))
+
+        lines = []
+        for key, histogram in sorted(self.histograms.items()):
+            if key[0].startswith(prefix):
+                lines.append(f'{label(key)}: n={histogram.count} mean={histogram.mean:.3f} '
+                             f'p50<={histogram.percentile(0.5)} p99<={histogram.percentile(0.99)} '
+                             f'max={histogram.max:.3f}')
+
+        for key, value in sorted(self.gauges.items()):
+            if key[0].startswith(prefix):
+                lines.append(f'{label(key)}: {value}')
+
+        for key, value in sorted(self.counters.items()):
+            if key[0].startswith(prefix):
+                lines.append(f'{label(key)}: {value}')
+
+        return '\n'.join(lines)
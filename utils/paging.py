@@ -0,0 +1,229 @@
+import inspect
+from collections import OrderedDict
+
+import discord
+from libneko import pag
+
+
+class KeysetSource:
+    """Pulls the rows of a query page by page with keyset pagination.
+
+    A page is fetched with ``WHERE key > last key ORDER BY key LIMIT n``
+    right after the page before it, or with the reversed query right
+    before the page after it, so flipping through pages never scans the
+    skipped rows. Pages without a loaded neighbour fall back to ``OFFSET``.
+    Only the most recently used pages are kept.
+
+    Parameters
+    -----------
+    pool
+        The pool or the connection to run the queries on.
+    table: str
+        The ``FROM`` clause of the query.
+    columns: str
+        The ``SELECT`` clause of the query, it must select the key columns.
+    key: Union[str, Tuple[str, ...]]
+        The columns the rows are ordered by, together they must be unique.
+    where: Optional[str]
+        The ``WHERE`` clause of the query, its values are given as ``$1``, ``$2``, ...
+    args: Tuple
+        The values of the ``WHERE`` clause.
+    per_page: int
+        The number of rows of a page.
+    max_pages: int
+        The number of pages to keep in memory.
+    """
+
+    def __init__(self, pool, table, columns, key, *, where=None, args=(), per_page=10, max_pages=32):
+        self.pool = pool
+        self.table = table
+        self.columns = columns
+        self.key = (key,) if isinstance(key, str) else tuple(key)
+        self.where = where
+        self.args = tuple(args)
+        self.per_page = per_page
+        self.max_pages = max_pages
+        self.row_count = None
+        # page index -> rows, the least recently used first
+        self._pages = OrderedDict()
+
+    def _query(self, *, after=False, before=False, offset=False, limit=None):
+        conditions = [f'({self.where})'] if self.where else []
+        keys = ', '.join(self.key)
+        if after or before:
+            params = ', '.join(f'${len(self.args) + i}' for i in range(1, len(self.key) + 1))
+            conditions.append(f'({keys}) {">" if after else "<"} ({params})')
+
+        order = ', '.join(f'{column} DESC' for column in self.key) if before else keys
+        sql = f'SELECT {self.columns} FROM {self.table}'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += f' ORDER BY {order} LIMIT {limit or self.per_page}'
+        if offset:
+            sql += f' OFFSET ${len(self.args) + 1}'
+        return sql
+
+    def _key_of(self, row):
+        return tuple(row[column.split('.')[-1]] for column in self.key)
+
+    async def count(self):
+        """Returns the number of rows, it is only counted once."""
+        if self.row_count is None:
+            sql = f'SELECT COUNT(*) FROM {self.table}'
+            if self.where:
+                sql += f' WHERE {self.where}'
+            self.row_count = await self.pool.fetchval(sql, *self.args)
+        return self.row_count
+
+    async def page_count(self):
+        return max(1, -(-await self.count() // self.per_page))
+
+    async def page(self, index):
+        """Returns the rows of a page, the first page is 0."""
+        try:
+            rows = self._pages[index]
+        except KeyError:
+            pass
+        else:
+            self._pages.move_to_end(index)
+            return rows
+
+        if index - 1 in self._pages and self._pages[index - 1]:
+            last = self._key_of(self._pages[index - 1][-1])
+            rows = await self.pool.fetch(self._query(after=True), *self.args, *last)
+        elif index + 1 in self._pages and self._pages[index + 1]:
+            first = self._key_of(self._pages[index + 1][0])
+            rows = await self.pool.fetch(self._query(before=True), *self.args, *first)
+            rows.reverse()
+        else:
+            rows = await self.pool.fetch(self._query(offset=True), *self.args, index * self.per_page)
+
+        self._pages[index] = rows
+        while len(self._pages) > self.max_pages:
+            self._pages.popitem(last=False)
+        return rows
+
+    async def rows(self, *, batch=500):
+        """Yields every row from the first one on without keeping the pages."""
+        rows = await self.pool.fetch(self._query(limit=batch), *self.args)
+        while rows:
+            for row in rows:
+                yield row
+
+            if len(rows) < batch:
+                break
+
+            last = self._key_of(rows[-1])
+            rows = await self.pool.fetch(self._query(after=True, limit=batch), *self.args, *last)
+
+    async def row(self, number):
+        """Returns the row of the given row number, the first row is 1."""
+        rows = await self.page((number - 1) // self.per_page)
+        try:
+            return rows[(number - 1) % self.per_page]
+        except IndexError:
+            return None
+
+
+class _LazyPages:
+    """The page sequence of a lazy navigator, pages are rendered once they are loaded."""
+
+    def __init__(self, source, render, page_count, placeholder):
+        self.source = source
+        self.render = render
+        self.page_count = page_count
+        self.placeholder = placeholder
+        self._rendered = OrderedDict()
+
+    def __len__(self):
+        return self.page_count
+
+    def __iter__(self):
+        # the navigator only checks that no page is empty
+        return (self[index] for index in range(self.page_count))
+
+    def __getitem__(self, index):
+        try:
+            return self._rendered[index]
+        except KeyError:
+            if not 0 <= index < self.page_count:
+                raise IndexError(index) from None
+            return self.placeholder()
+
+    async def load(self, index):
+        if index in self._rendered:
+            self._rendered.move_to_end(index)
+            return
+
+        rows = await self.source.page(index)
+        page = self.render(rows, index * self.source.per_page + 1)
+        if inspect.isawaitable(page):
+            page = await page
+
+        self._rendered[index] = page
+        while len(self._rendered) > self.source.max_pages:
+            self._rendered.popitem(last=False)
+
+
+class _LazyNavigatorMixin:
+    """Loads the page about to be shown from the source of the navigator.
+
+    Parameters
+    -----------
+    ctx: commands.Context
+        The context of the command.
+    source: KeysetSource
+        The source of the rows.
+    render: Callable[[List[asyncpg.Record], int], Union[PageT, Awaitable[PageT]]]
+        Renders the rows of a page with the row number of its first row.
+    page_count: int
+        The number of pages, see :meth:`KeysetSource.page_count`.
+    """
+
+    placeholder = None
+
+    def __init__(self, ctx, source, render, page_count, **kwargs):
+        super().__init__(ctx, _LazyPages(source, render, page_count, self.placeholder), **kwargs)
+
+    async def _edit_page(self):
+        await self.pages.load(self.page_index)
+        await super()._edit_page()
+
+
+class LazyEmbedNavigator(_LazyNavigatorMixin, pag.EmbedNavigator):
+    """An embed navigator that only loads a page from its source once it is shown."""
+
+    @staticmethod
+    def placeholder():
+        return discord.Embed(description='Loading...')
+
+
+class LazyStringNavigator(_LazyNavigatorMixin, pag.StringNavigator):
+    """A string navigator that only loads a page from its source once it is shown."""
+
+    @staticmethod
+    def placeholder():
+        return 'Loading...'
+
+
+def lines_page(title, format_row, *, separator='**-----------------------------**'):
+    """Returns a page renderer putting a line per row into the description of an embed.
+
+    ``format_row`` is called with the row and its row number and may be a coroutine function.
+    """
+    async def render(rows, start):
+        lines = [title]
+        for number, row in enumerate(rows, start):
+            line = format_row(row, number)
+            if inspect.isawaitable(line):
+                line = await line
+            lines.append(line)
+            if separator:
+                lines.append(separator)
+
+        description = '\n'.join(lines)
+        if len(description) > 2048:
+            description = description[:2045] + '...'
+        return discord.Embed(description=description)
+
+    return render
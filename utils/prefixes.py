@@ -0,0 +1,69 @@
+import re
+
+
+class PrefixResolver:
+    """Resolves and caches the command prefixes of every guild.
+
+    The prefixes of a guild are kept as a tuple, the mention forms first
+    followed by the guild prefixes as they are stored, together with a
+    compiled pattern matching any of them. An entry is dropped whenever
+    the prefixes of its guild change in the store.
+
+    Parameters
+    -----------
+    bot: commands.Bot
+        The bot, its user provides the mention forms.
+    store: Config
+        The guild id to prefix list mapping.
+    base_prefixes: List[str]
+        The prefixes of the DMs and of the guilds without custom prefixes.
+    """
+
+    def __init__(self, bot, store, base_prefixes):
+        self.bot = bot
+        self.store = store
+        self.base_prefixes = base_prefixes
+        # guild_id (None for DMs): (prefixes, pattern)
+        self._cache = {}
+        store.on_change = self._changed
+
+    def _changed(self, key):
+        self._cache.pop(int(key), None)
+
+    def invalidate(self, guild_id=None):
+        """Drops the entry of a guild, or every entry without a guild id."""
+        if guild_id is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(guild_id, None)
+
+    def raw(self, guild_id):
+        """Returns the prefixes of a guild without the mention forms."""
+        return self.store.get(guild_id, self.base_prefixes)
+
+    def _resolve(self, guild):
+        guild_id = guild.id if guild is not None else None
+        try:
+            return self._cache[guild_id]
+        except KeyError:
+            pass
+
+        raw = self.base_prefixes if guild is None else self.raw(guild_id)
+        user = self.bot.user
+        # the mention forms are unknown until the bot has logged in, nothing is cached until then
+        if user is None:
+            return tuple(raw), None
+
+        prefixes = (f'<@{user.id}> ', f'<@!{user.id}> ', *raw)
+        pattern = re.compile('|'.join(map(re.escape, sorted(prefixes, key=len, reverse=True))))
+        entry = self._cache[guild_id] = (prefixes, pattern)
+        return entry
+
+    def get(self, guild):
+        """Returns the prefixes of a guild, or of the DMs if it is ``None``."""
+        return self._resolve(guild)[0]
+
+    def matches(self, message):
+        """Checks whether a message starts with one of the prefixes of its guild."""
+        pattern = self._resolve(message.guild)[1]
+        return pattern is None or pattern.match(message.content) is not None
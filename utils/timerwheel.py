@@ -0,0 +1,265 @@
+import os
+import json
+import math
+import time
+import asyncio
+import logging
+
+log = logging.getLogger('root')
+
+
+class TimerJournal:
+    """An append-only JSON lines journal of the entries of a :class:`TimingWheel`.
+
+    Lines are buffered and written behind on the default executor,
+    at most one write is in flight at any time so the order is kept.
+    Once the journal grows over ``compact_size`` bytes it should be
+    rewritten with the live entries only, see :meth:`compact`.
+    """
+
+    def __init__(self, name, *, loop=None, compact_size=64 * 1024):
+        self.name = name
+        self.loop = loop or asyncio.get_event_loop()
+        self.compact_size = compact_size
+        self._buffer = []
+        self._pending = None
+        # a truncate requested while a write was in flight, applied by the next write
+        self._truncate = False
+        try:
+            # bytes of the journal, written or buffered
+            self.size = os.path.getsize(name)
+        except OSError:
+            self.size = 0
+        # the size right after the last compaction, the live entries alone may be over compact_size
+        self._compacted_size = 0
+
+    def replay(self):
+        """Returns the entries that were added but never completed, keyed by their key."""
+        entries = {}
+        try:
+            with open(self.name, 'r', encoding='utf-8') as fp:
+                for line in fp:
+                    try:
+                        data = json.loads(line)
+                    except ValueError:
+                        # a torn write at the end of the file
+                        continue
+
+                    if data['op'] == 'add':
+                        entries[data['key']] = (data['expires'], data['payload'])
+                    else:
+                        entries.pop(data['key'], None)
+        except FileNotFoundError:
+            pass
+
+        return entries
+
+    def append(self, op, key, expires=None, payload=None):
+        if op == 'add':
+            data = {'op': op, 'key': key, 'expires': expires, 'payload': payload}
+        else:
+            data = {'op': op, 'key': key}
+        line = json.dumps(data, ensure_ascii=True, separators=(',', ':'))
+        self._buffer.append(line)
+        self.size += len(line) + 1
+
+    def _write(self, lines, truncate):
+        with open(self.name, 'w' if truncate else 'a', encoding='utf-8') as fp:
+            for line in lines:
+                fp.write(line + '\n')
+
+    def flush(self, *, truncate=False):
+        """Writes the buffered lines, ``truncate`` drops the journal if nothing is pending anymore.
+
+        A truncate requested while a write is in flight is kept and done by
+        the write that follows it, the lines buffered after it are kept.
+        """
+        if truncate:
+            # every line so far belongs to a completed entry
+            self._buffer = []
+            self._truncate = True
+            self.size = self._compacted_size = 0
+
+        if self._pending is not None and not self._pending.done():
+            return
+
+        if not self._buffer and not self._truncate:
+            return
+
+        lines, self._buffer = self._buffer, []
+        truncate, self._truncate = self._truncate, False
+        self._pending = self.loop.run_in_executor(None, self._write, lines, truncate)
+        self._pending.add_done_callback(self._flushed)
+
+    def needs_compaction(self):
+        return self.size > max(self.compact_size, 2 * self._compacted_size)
+
+    def compact(self, entries):
+        """Rewrites the journal with only the given ``(key, expires, payload)`` entries.
+
+        The entries must be every live entry, the lines written or buffered
+        so far are dropped. The rewrite is queued like a truncate.
+        """
+        self._buffer = []
+        self.size = 0
+        for key, expires, payload in entries:
+            self.append('add', key, expires, payload)
+        self._compacted_size = self.size
+        self._truncate = True
+        self.flush()
+
+    def _flushed(self, future):
+        if future.exception() is not None:
+            log.error(f'Could not write timer journal {self.name}: {future.exception()}')
+
+        if self._buffer or self._truncate:
+            self.flush()
+
+    def close(self, *, truncate=False):
+        """Synchronously writes whatever is still buffered."""
+        if truncate:
+            self._buffer = []
+            self.size = self._compacted_size = 0
+        lines, self._buffer = self._buffer, []
+        truncate, self._truncate = truncate or self._truncate, False
+        if lines or truncate:
+            self._write(lines, truncate)
+
+
+class TimingWheel:
+    """A hashed timing wheel for short timers.
+
+    Every entry is put in the slot of the tick it expires in and the whole
+    wheel is driven by a single loop callback per tick, so thousands of
+    pending timers do not cost a sleeping coroutine each. The callback is
+    only scheduled while the wheel has entries.
+
+    Parameters
+    -----------
+    callback: Callable[[Any], None]
+        Called with the payload of an entry once it expires.
+    tick: float
+        The resolution of the wheel in seconds.
+    slots: int
+        The number of slots. Entries further away than ``tick * slots``
+        seconds stay in their slot for another round.
+    journal: Optional[str]
+        The file to journal the entries to, so that they survive a restart.
+    compact_size: int
+        The size in bytes over which the journal is rewritten with the pending entries only.
+    """
+
+    def __init__(self, callback, *, tick=0.5, slots=128, journal=None, compact_size=64 * 1024, loop=None):
+        self.callback = callback
+        self.tick = tick
+        self.loop = loop or asyncio.get_event_loop()
+        self._slots = [{} for _ in range(slots)]
+        # key -> slot index
+        self._index = {}
+        self._handle = None
+        # the last tick whose slot has been processed
+        self._last_tick = math.floor(time.time() / tick) - 1
+        self.journal = TimerJournal(journal, loop=self.loop, compact_size=compact_size) if journal else None
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def entries(self):
+        """Returns the ``(key, expires, payload)`` entries that are pending."""
+        return [(key, *self._slots[slot][key]) for key, slot in self._index.items()]
+
+    def replay(self):
+        """Returns the ``(key, expires, payload)`` entries left in the journal by a previous run.
+
+        The entries should be added back with their keys, the journal
+        keeps them until they complete.
+        """
+        if self.journal is None:
+            return []
+
+        entries = self.journal.replay()
+        return [(key, expires, payload) for key, (expires, payload) in entries.items()]
+
+    def add(self, key, expires, payload):
+        """Adds an entry expiring at the given UNIX timestamp."""
+        if key in self._index:
+            raise KeyError(f'Duplicate timer key {key}.')
+
+        # overdue entries go in the current slot and fire on the next tick
+        slot = max(math.floor(expires / self.tick), math.floor(time.time() / self.tick)) % len(self._slots)
+        self._slots[slot][key] = (expires, payload)
+        self._index[key] = slot
+
+        if self.journal is not None:
+            self.journal.append('add', key, expires, payload)
+
+        self._schedule()
+
+    def remove(self, key):
+        """Removes an entry, returns its payload or ``None`` if it is not pending."""
+        try:
+            slot = self._index.pop(key)
+        except KeyError:
+            return None
+
+        _, payload = self._slots[slot].pop(key)
+        if self.journal is not None:
+            self.journal.append('done', key)
+        return payload
+
+    def _schedule(self):
+        if self._handle is not None or not self._index:
+            return
+
+        now = time.time()
+        # every slot is empty while the wheel is idle, so the ticks that passed meanwhile can be skipped
+        current = math.floor(now / self.tick)
+        self._last_tick = max(self._last_tick, current - 1)
+        delay = (current + 1) * self.tick - now
+        self._handle = self.loop.call_later(delay, self._on_tick)
+
+    def _on_tick(self):
+        self._handle = None
+        now = time.time()
+        # a slot is processed once its tick is over, a late callback processes every missed slot
+        until = math.floor(now / self.tick) - 1
+        fired = []
+        start = max(self._last_tick + 1, until + 1 - len(self._slots))
+        for tick in range(start, until + 1):
+            slot = self._slots[tick % len(self._slots)]
+            due = [key for key, (expires, _) in slot.items() if expires <= now]
+            for key in due:
+                _, payload = slot.pop(key)
+                del self._index[key]
+                fired.append((key, payload))
+
+        self._last_tick = max(self._last_tick, until)
+
+        for key, payload in fired:
+            if self.journal is not None:
+                self.journal.append('done', key)
+            try:
+                self.callback(payload)
+            except Exception:
+                log.exception(f'Short timer callback has failed for {key}.')
+
+        if self.journal is not None:
+            if self._index and self.journal.needs_compaction():
+                # a busy wheel is rarely empty, so the journal is not left to grow until it is
+                self.journal.compact(self.entries())
+            else:
+                self.journal.flush(truncate=not self._index)
+
+        self._schedule()
+
+    def close(self):
+        """Stops the wheel and writes the pending journal lines."""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+        if self.journal is not None:
+            self.journal.close(truncate=not self._index)